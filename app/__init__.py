@@ -1,9 +1,16 @@
 from .config import Config
 from flask import Flask
-from .models import Base, User
+from .models import Base, User, migrate_recipes_table, migrate_users_table
 from .db_api_responses import init_db
+from .recipe_store import init_recipe_store
+from .random_pool import start_refill
+from .singleflight import init_leases
+from .budget import init_budget
+from .image_proxy import fetch_image, image_url
+from .password_hashing import start_hashing_pool
 from .extensions import login_manager, sqlalchemy_db, csrf, bootstrap
-from flask_session import Session
+from .session_store import init_sessions
+from .metrics import init_metrics
 
 
 def create_app() -> Flask:
@@ -22,19 +29,23 @@ def create_app() -> Flask:
     app.config["SESSION_COOKIE_HTTPONLY"] = True
     app.config["REMEMBER_COOKIE_SECURE"] = True
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-    app.config['SESSION_TYPE'] = 'sqlalchemy'
-    app.config['SESSION_SQLALCHEMY'] = sqlalchemy_db
     app.config['SESSION_PERMANENT'] = False
+    # downloads dish photos for the image proxy - replaceable with a local stub
+    app.config['IMAGE_FETCHER'] = fetch_image
 
     # Initialize the database
     init_db()
+    init_recipe_store()
+    init_leases()
+    init_budget()
 
     # Initialize Flask extensions
     sqlalchemy_db.init_app(app)
     login_manager.init_app(app)
     bootstrap.init_app(app)
     csrf.init_app(app)
-    Session(app)
+    init_sessions(app)
+    init_metrics(app)
 
     # configure Flask-login
     login_manager.login_view = 'auth.login'  # Redirect to 'auth.login' when login is required
@@ -44,9 +55,18 @@ def create_app() -> Flask:
     from .routes import main_bp, auth_bp
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp)
+    app.add_template_global(image_url)
 
     # create database tables
     with app.app_context():
         sqlalchemy_db.create_all()
+        migrate_recipes_table()
+        migrate_users_table()
+
+    start_hashing_pool()
+
+    # fill the pool of random recipes before the first visitor arrives
+    if Config.RANDOM_POOL_PREWARM:
+        start_refill()
 
     return app
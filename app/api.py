@@ -1,3 +1,4 @@
+from . import http_client
 from .config import Config
 import requests
 import json
@@ -8,20 +9,19 @@ with open('data.json', 'r') as file:
 
 
 def search_recipe(dish_name: str = None, user_intolerances: list[str] = None, cuisine_type: list[str] = None,
-                  diet_type: list[str] = None) -> requests.models.Response | int:
+                  diet_type: list[str] = None, offset: int = 0) -> requests.models.Response | int:
     """
     Queries the spoonacular API for the recipe, taking into account the user's preferences.
+    Results are lean - id, title and photo - the details of a recipe are fetched once it's opened
+    (see get_recipe_information). Pages after the first one start at the given offset.
     :return: requests.Response | int: API response if recipes are found, otherwise 1.
     """
-    endpoint = 'https://api.spoonacular.com/recipes/complexSearch'
-
-    header = {'x-api-key': Config.API_KEY}
     data = {'sort': 'popularity',
-            'number': 12,
+            'number': Config.SEARCH_PAGE_SIZE,
             'instructionsRequired': 'true',
-            'addRecipeInstructions': 'true',
-            'addRecipeNutrition': 'true'
             }
+    if offset:
+        data['offset'] = offset
 
     # Add all user's preferences to 'data':
     if dish_name is not None:
@@ -42,7 +42,10 @@ def search_recipe(dish_name: str = None, user_intolerances: list[str] = None, cu
         string = ','.join(diet_type)
         data['diet'] = string
 
-    response = requests.get(url=endpoint, headers=header, params=data)
+    try:
+        response = http_client.get('complexSearch', params=data)
+    except requests.RequestException:
+        raise InternalServerError("Spoonacular API is unreachable.")
 
     try:
         if len(response.json()['results']) > 0:
@@ -62,12 +65,12 @@ def get_random_recipes(num_recipes: int) -> requests.models.Response | int:
     Returns:
         requests.Response | int: API response if recipes are found, otherwise 1.
     """
-    endpoint = 'https://api.spoonacular.com/recipes/random'
-
-    header = {'x-api-key': Config.API_KEY}
     data = {'number': num_recipes}
 
-    response = requests.get(url=endpoint, headers=header, params=data)
+    try:
+        response = http_client.get('random', params=data)
+    except requests.RequestException:
+        raise InternalServerError("Spoonacular API is unreachable.")
 
     try:
         if len(response.json()['recipes']) > 0:
@@ -76,3 +79,25 @@ def get_random_recipes(num_recipes: int) -> requests.models.Response | int:
             return 1
     except KeyError:
         raise InternalServerError("Key 'recipes' is missing")
+
+
+def get_recipe_information(recipe_id: int) -> requests.models.Response | int:
+    """
+    Fetches the full information about one recipe: instructions and ingredients, without nutrition.
+    :return: requests.Response | int: API response if the recipe exists, otherwise 1.
+    """
+    try:
+        response = http_client.get(f'{recipe_id}/information', params={'includeNutrition': 'false'})
+    except requests.RequestException:
+        raise InternalServerError("Spoonacular API is unreachable.")
+
+    if response.status_code == 404:
+        return 1
+    if response.status_code >= 400:
+        raise InternalServerError("Spoonacular API refused the request.")
+    try:
+        if 'title' in response.json():
+            return response
+    except ValueError:
+        pass
+    raise InternalServerError("Invalid recipe information in API response.")
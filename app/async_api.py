@@ -0,0 +1,103 @@
+import asyncio
+import os
+import random
+import threading
+from concurrent.futures import TimeoutError
+import requests
+from .config import Config
+
+try:
+    import httpx
+except ImportError:  # without httpx, UPSTREAM_MODE=async falls back to the requests session
+    httpx = None
+
+# statuses retried like by the requests session (see http_client.create_session)
+RETRY_STATUSES = {500, 502, 503, 504}
+
+loop = None
+client = None
+loop_pid = None
+loop_lock = threading.Lock()
+
+
+def is_available() -> bool:
+    return httpx is not None
+
+
+def start_loop() -> asyncio.AbstractEventLoop:
+    """
+    Starts the event loop of the current process in a background thread, with an httpx client whose connection
+    pool is shared by all upstream calls of the process. Restarted after fork, like the requests session.
+    """
+    global loop, client, loop_pid
+    pid = os.getpid()
+    if loop is None or loop_pid != pid:
+        with loop_lock:
+            if loop is None or loop_pid != pid:
+                new_loop = asyncio.new_event_loop()
+                threading.Thread(target=new_loop.run_forever, name='upstream-loop', daemon=True).start()
+                client = httpx.AsyncClient(
+                    headers={'x-api-key': Config.API_KEY or '', 'Accept': 'application/json'},
+                    limits=httpx.Limits(max_connections=Config.ASYNC_MAX_CONNECTIONS,
+                                        max_keepalive_connections=Config.HTTP_POOL_MAXSIZE))
+                loop, loop_pid = new_loop, pid
+    return loop
+
+
+async def fetch(url: str, params: dict, timeout: tuple[float, float]) -> 'httpx.Response':
+    """
+    Sends a GET request on the event loop, retrying connection errors and 5xx responses
+    HTTP_RETRIES times with jittered exponential backoff, honouring Retry-After.
+    """
+    connect_timeout, read_timeout = timeout
+    for attempt in range(Config.HTTP_RETRIES + 1):
+        last_attempt = attempt == Config.HTTP_RETRIES
+        delay = Config.HTTP_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, Config.HTTP_BACKOFF_FACTOR)
+        try:
+            response = await client.get(url, params=params,
+                                        timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        except httpx.TransportError:
+            if last_attempt:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = float(retry_after)
+        await asyncio.sleep(delay)
+
+
+def run(coroutine, timeout: float):
+    """
+    Runs a coroutine on the event loop of the process and waits for it.
+    Only the HTTP exchange happens on the loop - budget and database work stays on the calling thread.
+    :return: result of the coroutine
+    :raise requests.Timeout: the coroutine didn't finish within timeout seconds
+    """
+    future = asyncio.run_coroutine_threadsafe(coroutine, start_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise requests.Timeout('Upstream call did not finish in time.')
+
+
+def send(url: str, params: dict, timeout: tuple[float, float]) -> 'httpx.Response':
+    """
+    Sends a GET request over the shared connection pool, blocking only the calling thread.
+    :param timeout: (connect timeout, read timeout) of one attempt
+    :raise requests.RequestException: connection failed, timed out or retries were exhausted
+    """
+    try:
+        return run(fetch(url, params, timeout),
+                   timeout=sum(timeout) * (Config.HTTP_RETRIES + 1) + Config.HTTP_RETRIES * 10)
+    except httpx.HTTPError as e:
+        raise as_requests_error(e)
+
+
+def as_requests_error(error: 'httpx.HTTPError') -> requests.RequestException:
+    """Translates httpx errors to the requests exceptions callers of http_client.get handle."""
+    if isinstance(error, httpx.TimeoutException):
+        return requests.Timeout(str(error))
+    return requests.ConnectionError(str(error))
@@ -1,19 +1,18 @@
-from werkzeug.security import generate_password_hash, check_password_hash
+from .password_hashing import hash_password, verify_password, needs_rehash, HashingBusy
 from flask_login import login_user
 from .models import User
 from .extensions import sqlalchemy_db
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 
 def add_user(email, password, name) -> User | None:
-    """Creates a new user and stores it in the database."""
+    """
+    Creates a new user and stores it in the database.
+    :raise HashingBusy: too many passwords are being hashed at the moment
+    """
     session = sqlalchemy_db.session
+    hash_and_salted_password = hash_password(password)
     try:
-        hash_and_salted_password = generate_password_hash(
-            password,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
         new_user = User(
             email=email,
             name=name,
@@ -38,6 +37,7 @@ def register_check_if_user_exists(form) -> int:
     :return:  1 - User already exists,
         0 - User does not exist and is registered successfully
         2 - User does not exist and registration has failed
+        3 - too many passwords are being hashed at the moment, the user should try again later
     """
     session = sqlalchemy_db.session
     result = session.execute(sqlalchemy_db.select(User).where(User.email == form.email.data))
@@ -45,7 +45,10 @@ def register_check_if_user_exists(form) -> int:
 
     if user:
         return 1
-    new_user = add_user(email=form.email.data, password=form.password.data, name=form.name.data)
+    try:
+        new_user = add_user(email=form.email.data, password=form.password.data, name=form.name.data)
+    except HashingBusy:
+        return 3
     if new_user:
         login_user(new_user)
         return 0
@@ -58,13 +61,27 @@ def login_check_if_user_exists(form) -> int:
     :return: 1 - user with this email doesn't exist,
         2 - password incorrect (but user with this email exists),
         0 - email and password correct - successful login
+        3 - too many passwords are being hashed at the moment, the user should try again later
     """
     session = sqlalchemy_db.session
     result = session.execute(sqlalchemy_db.select(User).where(User.email == form.email.data))
     user = result.scalar()
     if not user:
         return 1
-    elif not check_password_hash(user.password, form.password.data):
-        return 2
+    try:
+        if not verify_password(user.password, form.password.data):
+            return 2
+    except HashingBusy:
+        return 3
+    if needs_rehash(user.password):
+        # the hashing parameters have changed since the password was set - the old hash keeps working meanwhile
+        try:
+            user.password = hash_password(form.password.data)
+            session.commit()
+        except HashingBusy:
+            pass
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Error while rehashing the password of user {user.id}: {e}")
     login_user(user)
     return 0
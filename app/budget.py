@@ -0,0 +1,163 @@
+import sqlite3
+import time
+import requests
+from werkzeug.exceptions import InternalServerError
+from .config import Config
+from .db_api_responses import get_connection
+
+# modes of the budget, from the most to the least generous
+NORMAL = 'normal'
+PREFER_LOCAL = 'prefer_local'
+SERVE_STALE = 'serve_stale'
+REJECT = 'reject'
+
+
+class BudgetExhausted(InternalServerError):
+    """Raised instead of calling the API when the daily spoonacular quota is (nearly) used up."""
+    description = "The daily API quota has been used up."
+
+
+def endpoint_name(endpoint: str) -> str:
+    """:return: endpoint without the recipe id, e.g. 'information' for '123/information'"""
+    return endpoint.rsplit('/', 1)[-1]
+
+
+def estimate_cost(endpoint: str, params: dict) -> float:
+    """
+    Estimates the quota points of a request, following spoonacular's pricing:
+    1 point per request, 0.01 per returned recipe and 0.025 per recipe for every added section.
+    Information about one recipe costs 1 point, nutrition included 0.025 more.
+    """
+    if endpoint_name(endpoint) == 'information':
+        return 1 + (0.025 if params.get('includeNutrition') == 'true' else 0)
+    number = int(params.get('number', 1))
+    cost = 1 + 0.01 * number
+    if endpoint == 'complexSearch':
+        for section in ['addRecipeInformation', 'addRecipeInstructions', 'addRecipeNutrition']:
+            if params.get(section) == 'true':
+                cost += 0.025 * number
+    return cost
+
+
+def current_day() -> str:
+    """:return: the current day of the quota - spoonacular resets quotas at midnight UTC"""
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+def init_budget() -> None:
+    """Creates the tables recording points spent on the API, shared by all workers."""
+    try:
+        connection = get_connection()
+        with connection:
+            connection.execute('''
+                               CREATE TABLE IF NOT EXISTS api_budget (
+                               day TEXT NOT NULL,
+                               endpoint TEXT NOT NULL,
+                               points REAL NOT NULL DEFAULT 0,
+                               requests INTEGER NOT NULL DEFAULT 0,
+                               PRIMARY KEY (day, endpoint)
+                               )''')
+            connection.execute('''
+                               CREATE TABLE IF NOT EXISTS api_quota (
+                               day TEXT PRIMARY KEY,
+                               used REAL NOT NULL,
+                               quota_left REAL NOT NULL,
+                               updated_at REAL NOT NULL
+                               )''')
+    except sqlite3.Error as e:
+        print(f"Budget table initialization error: {e}")
+
+
+def record_response(endpoint: str, params: dict, response: requests.models.Response) -> None:
+    """
+    Records points spent on a request. Uses spoonacular's X-API-Quota-* headers when present,
+    otherwise the estimated cost. A 402 response means the quota is used up.
+    Requests about single recipes are recorded together, e.g. '123/information' as 'information'.
+    """
+    headers = response.headers
+    points = float(headers.get('X-API-Quota-Request', estimate_cost(endpoint, params)))
+    endpoint = endpoint_name(endpoint)
+    day = current_day()
+    try:
+        connection = get_connection()
+        with connection:
+            connection.execute('''INSERT INTO api_budget (day, endpoint, points, requests) VALUES (?, ?, ?, 1)
+                                  ON CONFLICT (day, endpoint) DO UPDATE SET points = points + excluded.points,
+                                  requests = requests + 1''', (day, endpoint, points))
+            if 'X-API-Quota-Left' in headers:
+                used = float(headers.get('X-API-Quota-Used', 0))
+                quota_left = float(headers['X-API-Quota-Left'])
+            elif response.status_code == 402:
+                used, quota_left = Config.API_DAILY_QUOTA, 0
+            else:
+                return
+            connection.execute('''INSERT INTO api_quota (day, used, quota_left, updated_at) VALUES (?, ?, ?, ?)
+                                  ON CONFLICT (day) DO UPDATE SET used = excluded.used,
+                                  quota_left = excluded.quota_left, updated_at = excluded.updated_at''',
+                               (day, used, quota_left, time.time()))
+    except sqlite3.Error as e:
+        print(f"Database error while recording API budget: {e}")
+
+
+def remaining_points() -> float:
+    """
+    :return: quota points left today - as last reported by spoonacular,
+        or API_DAILY_QUOTA minus points recorded today if it hasn't reported yet
+    """
+    day = current_day()
+    try:
+        connection = get_connection()
+        row = connection.execute('''SELECT quota_left FROM api_quota WHERE day = ?''', (day,)).fetchone()
+        if row is not None:
+            return row[0]
+        spent = connection.execute('''SELECT COALESCE(SUM(points), 0) FROM api_budget WHERE day = ?''',
+                                   (day,)).fetchone()[0]
+        return max(Config.API_DAILY_QUOTA - spent, 0)
+    except sqlite3.Error as e:
+        print(f"Database error while reading API budget: {e}")
+        return Config.API_DAILY_QUOTA
+
+
+def budget_mode(remaining: float = None) -> str:
+    """
+    Chooses how freely to use the API, by the fraction of today's quota left:
+    normal - local results only when there are enough of them,
+    prefer_local - any local results before the API,
+    serve_stale - also expired cached responses and random recipes,
+    reject - no new API calls at all.
+    """
+    if remaining is None:
+        remaining = remaining_points()
+    fraction = remaining / Config.API_DAILY_QUOTA if Config.API_DAILY_QUOTA else 0
+    if fraction > Config.BUDGET_PREFER_LOCAL_BELOW:
+        return NORMAL
+    if fraction > Config.BUDGET_SERVE_STALE_BELOW:
+        return PREFER_LOCAL
+    if fraction > Config.BUDGET_REJECT_BELOW:
+        return SERVE_STALE
+    return REJECT
+
+
+def check_budget(endpoint: str, params: dict) -> None:
+    """Raises BudgetExhausted if a request to the endpoint shouldn't be sent."""
+    remaining = remaining_points()
+    if budget_mode(remaining) == REJECT or remaining < estimate_cost(endpoint, params):
+        raise BudgetExhausted()
+
+
+def budget_status() -> dict:
+    """
+    Reports today's API budget.
+    :return: day, daily quota, points left, mode and points and requests spent per endpoint
+    """
+    remaining = remaining_points()
+    status = {'day': current_day(), 'daily_quota': Config.API_DAILY_QUOTA, 'remaining': remaining,
+              'mode': budget_mode(remaining), 'endpoints': {}}
+    try:
+        rows = get_connection().execute('''SELECT endpoint, points, requests FROM api_budget WHERE day = ?''',
+                                        (status['day'],)).fetchall()
+        for endpoint, points, request_count in rows:
+            status['endpoints'][endpoint] = {'points': points, 'requests': request_count}
+    except sqlite3.Error as e:
+        print(f"Database error while reading API budget: {e}")
+    return status
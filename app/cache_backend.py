@@ -0,0 +1,347 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable
+from .config import Config
+from .payload_format import compress, decompress
+from .metrics import TimedConnection
+
+
+class CacheBackend(ABC):
+    """
+    Key-value store of JSON-serializable values with expiry.
+    Backends holding bytes serialize values with payload_format.compress, so every node reads what any other wrote.
+    """
+    # True if the backend is shared by several hosts, not only by the workers of one
+    remote = False
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None:
+        """:return: value or None if the key is missing or expired"""
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """Stores a value for ttl seconds."""
+
+    @abstractmethod
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        """Stores a value for ttl seconds, unless the key holds an unexpired one. :return: True if stored"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Deletes a key, if it exists."""
+
+    @abstractmethod
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        """Deletes a key in one step with checking that it still holds the value. :return: True if deleted"""
+
+
+class MemoryLRUBackend(CacheBackend):
+    """In-process cache, dropping the least recently used values above max_entries. Values are kept as they are."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # key -> (expiry time, value), most recently used last
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def store(self, key: str, value: Any, ttl: float) -> None:
+        """Stores a value, dropping the least recently used ones above max_entries (called with the lock held)."""
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self.lock:
+            self.store(key, value, ttl)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        # checked and stored under one lock, so that only one of concurrent callers takes the key
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self.store(key, value, ttl)
+            return True
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic() or entry[1] != value:
+                return False
+            del self.entries[key]
+            return True
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Cache in a WAL-mode SQLite file, shared by all workers of a host.
+    Expired values are deleted on average every CACHE_PURGE_N_WRITES writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.thread_local = threading.local()
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''CREATE TABLE IF NOT EXISTS cache_entries (
+                                      key TEXT PRIMARY KEY,
+                                      value BLOB NOT NULL,
+                                      expires_at REAL NOT NULL
+                                      ) WITHOUT ROWID''')
+        except sqlite3.Error as e:
+            print(f"Cache initialization error: {e}")
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread, opening it on first use and after fork."""
+        connection = getattr(self.thread_local, 'connection', None)
+        if connection is None or self.thread_local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=Config.SQLITE_BUSY_TIMEOUT, factory=TimedConnection)
+            connection.execute('''PRAGMA journal_mode = WAL''')
+            connection.execute('''PRAGMA synchronous = NORMAL''')
+            self.thread_local.connection = connection
+            self.thread_local.pid = os.getpid()
+        return connection
+
+    def get(self, key: str) -> Any | None:
+        try:
+            row = self.get_connection().execute('''SELECT value, expires_at FROM cache_entries WHERE key = ?''',
+                                                (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Cache error while reading: {e}")
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        return decompress(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)''',
+                                   (key, compress(value), time.time() + ttl))
+                if random.randrange(Config.CACHE_PURGE_N_WRITES) == 0:
+                    connection.execute('''DELETE FROM cache_entries WHERE expires_at <= ?''', (time.time(),))
+        except sqlite3.Error as e:
+            print(f"Cache error while writing: {e}")
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        try:
+            connection = self.get_connection()
+            now = time.time()
+            with connection:
+                connection.execute('''DELETE FROM cache_entries WHERE key = ? AND expires_at <= ?''', (key, now))
+                cursor = connection.execute('''INSERT OR IGNORE INTO cache_entries (key, value, expires_at)
+                                               VALUES (?, ?, ?)''', (key, compress(value), now + ttl))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            print(f"Cache error while writing: {e}")
+            return True
+
+    def delete(self, key: str) -> None:
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''DELETE FROM cache_entries WHERE key = ?''', (key,))
+        except sqlite3.Error as e:
+            print(f"Cache error while deleting: {e}")
+
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        try:
+            connection = self.get_connection()
+            with connection:
+                cursor = connection.execute('''DELETE FROM cache_entries
+                                               WHERE key = ? AND value = ? AND expires_at > ?''',
+                                            (key, compress(value), time.time()))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            print(f"Cache error while deleting: {e}")
+            return False
+
+
+# deletes KEYS[1] only if it holds ARGV[1], atomically on the server
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisBackend(CacheBackend):
+    """
+    Cache in Redis, or any server speaking its protocol, shared by all hosts. Redis expires values itself.
+    Requires the redis package. When the server is unreachable, reads miss and writes are skipped.
+    """
+    remote = True
+
+    def __init__(self, url: str, prefix: str = Config.CACHE_KEY_PREFIX):
+        from redis import Redis, RedisError
+
+        self.client = Redis.from_url(url, socket_timeout=Config.CACHE_REDIS_TIMEOUT,
+                                     socket_connect_timeout=Config.CACHE_REDIS_TIMEOUT)
+        self.errors = RedisError
+        self.prefix = prefix
+
+    def get(self, key: str) -> Any | None:
+        try:
+            value = self.client.get(self.prefix + key)
+        except self.errors as e:
+            print(f"Cache error while reading: {e}")
+            return None
+        return decompress(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        try:
+            self.client.set(self.prefix + key, compress(value), px=max(int(ttl * 1000), 1))
+        except self.errors as e:
+            print(f"Cache error while writing: {e}")
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        try:
+            return bool(self.client.set(self.prefix + key, compress(value), px=max(int(ttl * 1000), 1), nx=True))
+        except self.errors as e:
+            print(f"Cache error while writing: {e}")
+            return True
+
+    def delete(self, key: str) -> None:
+        try:
+            self.client.delete(self.prefix + key)
+        except self.errors as e:
+            print(f"Cache error while deleting: {e}")
+
+    def delete_if_equal(self, key: str, value: Any) -> bool:
+        try:
+            return bool(self.client.eval(DELETE_IF_EQUAL_SCRIPT, 1, self.prefix + key, compress(value)))
+        except self.errors as e:
+            print(f"Cache error while deleting: {e}")
+            return False
+
+
+shared_backend = None
+shared_backend_pid = None
+shared_backend_lock = threading.Lock()
+
+
+def create_shared_backend() -> CacheBackend | None:
+    """
+    Creates the backend selected by CACHE_BACKEND:
+    memory - nothing is shared, every worker keeps its own in-process tier only,
+    sqlite - file in instance/ shared by the workers of the host,
+    redis - Redis server at CACHE_REDIS_URL shared by all hosts.
+    """
+    backend = Config.CACHE_BACKEND
+    if backend == 'memory':
+        return None
+    if backend == 'sqlite':
+        return SQLiteBackend(os.path.join('instance', Config.CACHE_DB_FILE))
+    if backend == 'redis':
+        return RedisBackend(Config.CACHE_REDIS_URL)
+    raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+
+
+def get_shared_backend() -> CacheBackend | None:
+    """Returns the shared backend of the current process, created again after fork. None with CACHE_BACKEND=memory."""
+    global shared_backend, shared_backend_pid
+    pid = os.getpid()
+    if shared_backend_pid != pid:
+        with shared_backend_lock:
+            if shared_backend_pid != pid:
+                shared_backend = create_shared_backend()
+                shared_backend_pid = pid
+    return shared_backend
+
+
+def get_remote_backend() -> CacheBackend | None:
+    """:return: the shared backend if other hosts share it too, otherwise None"""
+    backend = get_shared_backend()
+    return backend if backend is not None and backend.remote else None
+
+
+class TieredCache:
+    """
+    Read-through cache of one kind of values: an in-process LRU tier in front of the shared backend.
+    Values found in the shared backend are kept in the process for at most local_ttl seconds,
+    so changes made by other workers are seen after that long at the latest.
+    """
+
+    def __init__(self, namespace: str, max_local_entries: int, local_ttl: float):
+        self.namespace = namespace
+        self.local = MemoryLRUBackend(max_local_entries)
+        self.local_ttl = local_ttl
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+        self.counters_lock = threading.Lock()
+
+    def count(self, event: str) -> None:
+        with self.counters_lock:
+            self.counters[event] += 1
+
+    def get(self, key: str) -> Any | None:
+        """:return: value from the fastest tier holding it, None if none does"""
+        value = self.local.get(key)
+        if value is not None:
+            self.count('local_hits')
+            return value
+        backend = get_shared_backend()
+        value = backend.get(f'{self.namespace}:{key}') if backend is not None else None
+        if value is not None:
+            self.local.set(key, value, self.local_ttl)
+            self.count('shared_hits')
+            return value
+        self.count('misses')
+        return None
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """Stores a value in both tiers. Without a shared backend, the process keeps it for the whole ttl."""
+        backend = get_shared_backend()
+        if backend is None:
+            self.local.set(key, value, ttl)
+            return
+        self.local.set(key, value, min(ttl, self.local_ttl))
+        backend.set(f'{self.namespace}:{key}', value, ttl)
+
+    def get_or_load(self, key: str, load: Callable[[], Any], ttl: float) -> Any | None:
+        """:return: cached value, or the value returned by load(), which is then cached unless it's None"""
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+    def delete(self, key: str) -> None:
+        """Deletes a value from the shared backend and from the tier of this process."""
+        self.local.delete(key)
+        backend = get_shared_backend()
+        if backend is not None:
+            backend.delete(f'{self.namespace}:{key}')
+
+    def stats(self) -> dict:
+        """:return: hits in the process and in the shared backend, misses and the number of values in the process"""
+        with self.counters_lock:
+            return dict(self.counters, entries=len(self.local))
@@ -11,3 +11,84 @@ class Config:
     WTF_CSRF_SECRET_KEY = os.getenv('WTF_CSRF_SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
     SESSION_FILE_DIR = os.getenv('SESSION_FILE_DIR')
+    # cached API responses - lifetime in seconds and maximum number of stored responses
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 24 * 60 * 60))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 500))
+    # responses read by the writing process alone (random recipe slots, copies of remote responses) are written
+    # by a background thread per process, in batches, with at most this many queued - others are written right away
+    RESPONSE_WRITE_BEHIND = os.getenv('RESPONSE_WRITE_BEHIND', '1') == '1'
+    WRITE_BEHIND_MAX_PENDING = int(os.getenv('WRITE_BEHIND_MAX_PENDING', 1000))
+    WRITE_BEHIND_BATCH = int(os.getenv('WRITE_BEHIND_BATCH', 100))
+    # spoonacular HTTP client - connection pool, timeouts (seconds) and retries
+    SPOONACULAR_BASE_URL = os.getenv('SPOONACULAR_BASE_URL', 'https://api.spoonacular.com')
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 10))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+    SEARCH_READ_TIMEOUT = float(os.getenv('SEARCH_READ_TIMEOUT', 10))
+    RANDOM_READ_TIMEOUT = float(os.getenv('RANDOM_READ_TIMEOUT', 6))
+    INFORMATION_READ_TIMEOUT = float(os.getenv('INFORMATION_READ_TIMEOUT', 6))
+    HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+    HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.3))
+    # 'sync': requests session per process, 'async': httpx client on an event loop shared by all threads of a worker
+    UPSTREAM_MODE = os.getenv('UPSTREAM_MODE', 'sync')
+    ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', 100))
+    # pool of random recipes for the home page - size, refill threshold, batch size and maximum age in seconds
+    RANDOM_POOL_SIZE = int(os.getenv('RANDOM_POOL_SIZE', 300))
+    RANDOM_POOL_LOW_WATER = int(os.getenv('RANDOM_POOL_LOW_WATER', 100))
+    RANDOM_POOL_BATCH = int(os.getenv('RANDOM_POOL_BATCH', 100))
+    RANDOM_POOL_MAX_AGE = int(os.getenv('RANDOM_POOL_MAX_AGE', 6 * 60 * 60))
+    RANDOM_POOL_PREWARM = os.getenv('RANDOM_POOL_PREWARM', '1') == '1'
+    # searches are answered from the local recipe store when it finds at least this many recipes
+    LOCAL_SEARCH_MIN_HITS = int(os.getenv('LOCAL_SEARCH_MIN_HITS', 12))
+    # recipes per page of search results, pages spoonacular serves at most (offset up to 900),
+    # threads per worker fetching the next page of a viewed search in advance
+    SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 12))
+    SEARCH_MAX_PAGES = int(os.getenv('SEARCH_MAX_PAGES', 900 // 12))
+    SEARCH_PREFETCH_WORKERS = int(os.getenv('SEARCH_PREFETCH_WORKERS', 2))
+    # SQLite tuning of the responses database - seconds to wait for a lock, page cache size in KiB
+    SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5))
+    SQLITE_CACHE_KIB = int(os.getenv('SQLITE_CACHE_KIB', 16384))
+    # seconds a worker may hold an upstream call before others stop waiting for it
+    UPSTREAM_LEASE_TTL = float(os.getenv('UPSTREAM_LEASE_TTL', 35))
+    # spoonacular daily quota in points and fractions of it left, below which the app saves the API
+    API_DAILY_QUOTA = float(os.getenv('API_DAILY_QUOTA', 150))
+    BUDGET_PREFER_LOCAL_BELOW = float(os.getenv('BUDGET_PREFER_LOCAL_BELOW', 0.5))
+    BUDGET_SERVE_STALE_BELOW = float(os.getenv('BUDGET_SERVE_STALE_BELOW', 0.2))
+    BUDGET_REJECT_BELOW = float(os.getenv('BUDGET_REJECT_BELOW', 0.05))
+    # number of recipe cards on one page of saved recipes
+    SAVED_RECIPES_PAGE_SIZE = int(os.getenv('SAVED_RECIPES_PAGE_SIZE', 24))
+    # rendered recipe fragments kept in memory per process, and their lifetime in seconds in the shared cache
+    FRAGMENT_CACHE_MAX_ENTRIES = int(os.getenv('FRAGMENT_CACHE_MAX_ENTRIES', 1000))
+    FRAGMENT_CACHE_TTL = int(os.getenv('FRAGMENT_CACHE_TTL', 24 * 60 * 60))
+    # resized dish photos served by the image proxy
+    IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join('instance', 'image_cache'))
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+    IMAGE_READ_TIMEOUT = float(os.getenv('IMAGE_READ_TIMEOUT', 10))
+    # users loaded for Flask-Login are cached per process for this many seconds
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
+    USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 2048))
+    # cache shared by workers behind users, fragments and (with 'redis') responses and upstream leases:
+    # 'memory' (nothing shared), 'sqlite' (dedicated file in instance/, one host) or 'redis' (all hosts)
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+    CACHE_DB_FILE = os.getenv('CACHE_DB_FILE', 'cache.db')
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/1')
+    CACHE_REDIS_TIMEOUT = float(os.getenv('CACHE_REDIS_TIMEOUT', 0.5))
+    CACHE_KEY_PREFIX = os.getenv('CACHE_KEY_PREFIX', 'recipe-finder:')
+    # seconds a process keeps values of the shared cache, expired rows are deleted every this many writes on average
+    CACHE_LOCAL_TTL = float(os.getenv('CACHE_LOCAL_TTL', 30))
+    CACHE_PURGE_N_WRITES = int(os.getenv('CACHE_PURGE_N_WRITES', 1000))
+    # session store: 'sqlite' (dedicated file in instance/), 'redis' or 'sqlalchemy' (main database)
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+    SESSION_DB_FILE = os.getenv('SESSION_DB_FILE', 'sessions.db')
+    SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+    # expired sessions are deleted on average every this many requests, this many rows per transaction
+    SESSION_CLEANUP_N_REQUESTS = int(os.getenv('SESSION_CLEANUP_N_REQUESTS', 1000))
+    SESSION_PURGE_BATCH = int(os.getenv('SESSION_PURGE_BATCH', 500))
+    # password hashing: method with work factor as written in stored hashes, pool size and queue depth per worker
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+    PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 8))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+    # per-request latency breakdown (Server-Timing header and /metrics), token required by /metrics - unset hides it
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
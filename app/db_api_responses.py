@@ -1,74 +1,390 @@
+import atexit
 import sqlite3
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
 from .config import Config
-import requests
+from .payload_format import encode_recipes, decode_recipes, recipe_documents, LazyRecipes
+from .metrics import TimedConnection
+from .cache_backend import get_remote_backend
 import os
 
 db_file = Config.response_db_file
 os.makedirs("instance", exist_ok=True)
 db_path = os.path.join("instance", db_file)
 
+# hit/miss counters of the response cache (per process)
+cache_counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+counters_lock = threading.Lock()
+
+# one connection per thread, reopened after fork
+thread_local = threading.local()
+
+# accessed_at of a response is refreshed at most once per this many seconds, to spare writes on reads
+ACCESS_TOUCH_INTERVAL = 60
+
+# responses waiting for the writer thread, oldest first:
+# name -> (recipes, created_at, search page or None, True if taken from the remote cache backend)
+pending_writes = OrderedDict()
+pending_condition = threading.Condition()
+writer_thread = None
+writer_pid = None
+writes_stopped = False
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns the connection of the current thread to the responses database, opening it on first use.
+    Connections use WAL journal mode, so readers don't block the writer, and keep up to 128 prepared statements.
+    Statements are timed for the per-request metrics.
+    """
+    connection = getattr(thread_local, 'connection', None)
+    if connection is None or thread_local.pid != os.getpid():
+        connection = sqlite3.connect(db_path, timeout=Config.SQLITE_BUSY_TIMEOUT, cached_statements=128,
+                                     factory=TimedConnection)
+        connection.execute('''PRAGMA journal_mode = WAL''')
+        connection.execute('''PRAGMA synchronous = NORMAL''')
+        connection.execute(f'''PRAGMA cache_size = -{Config.SQLITE_CACHE_KIB}''')
+        connection.execute('''PRAGMA temp_store = MEMORY''')
+        thread_local.connection = connection
+        thread_local.pid = os.getpid()
+    return connection
+
 
 def init_db() -> None:
     """Initializes the SQLite database for storing API responses."""
-    connection = None
     try:
-        connection = sqlite3.connect(db_path, check_same_thread=False)
-        cursor = connection.cursor()
-        cursor.execute('''
-                       CREATE TABLE IF NOT EXISTS responses (
-                       id INTEGER PRIMARY KEY AUTOINCREMENT,
-                       name TEXT NOT NULL UNIQUE,
-                       json TEXT NOT NULL
-                       )''')
-        connection.commit()
+        connection = get_connection()
+        with connection:
+            connection.execute('''
+                           CREATE TABLE IF NOT EXISTS responses (
+                           id INTEGER PRIMARY KEY AUTOINCREMENT,
+                           name TEXT NOT NULL UNIQUE,
+                           json TEXT NOT NULL,
+                           created_at REAL NOT NULL DEFAULT 0,
+                           accessed_at REAL NOT NULL DEFAULT 0
+                           )''')
+            # databases created before the cache columns existed
+            columns = [row[1] for row in connection.execute('''PRAGMA table_info(responses)''')]
+            for column in ['created_at', 'accessed_at']:
+                if column not in columns:
+                    connection.execute(f'''ALTER TABLE responses ADD COLUMN {column} REAL NOT NULL DEFAULT 0''')
+            connection.execute('''CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)''')
+            # query behind every stored page of search results, to fetch the following pages
+            connection.execute('''
+                           CREATE TABLE IF NOT EXISTS search_pages (
+                           name TEXT PRIMARY KEY,
+                           params TEXT NOT NULL,
+                           page_offset INTEGER NOT NULL,
+                           total_results INTEGER
+                           )''')
     except sqlite3.Error as e:
         print(f"Database initialization error: {e}")
-    finally:
-        connection.close()
 
 
-def pass_response_to_database(unique_name: str, new_json_data: requests.models.Response | dict | list) -> None:
-    """Stores or updates an API response in the database."""
-    connection = None
+def make_cache_key(**params) -> str:
+    """
+    Builds a canonical key for a set of search parameters, so that identical queries share one cached response.
+    Parameter order, list order, letter case and surrounding whitespace do not change the key,
+    parameters set to None or to an empty list are skipped.
+    :return: hex digest of the canonical parameters
+    """
+    canonical = {}
+    for name, value in params.items():
+        if value is None or value == [] or value == '':
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(str(item).strip().lower() for item in value)
+        elif isinstance(value, str):
+            value = ' '.join(value.lower().split())
+        canonical[name] = value
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def is_content_addressed(unique_name: str) -> bool:
+    """
+    :return: True for names built by make_cache_key, which stand for the same response on every host -
+        unlike fixed slots such as '2' (random recipes of the home page), which every host fills itself
+    """
+    return len(unique_name) == 64 and all(char in '0123456789abcdef' for char in unique_name)
+
+
+def count_cache_event(event: str, amount: int = 1) -> None:
+    """Increments one of the response cache counters."""
+    with counters_lock:
+        cache_counters[event] += amount
+
+
+def evict_least_recently_used(connection: sqlite3.Connection) -> None:
+    """Deletes the least recently used responses above the RESPONSE_CACHE_MAX_ENTRIES limit."""
+    cursor = connection.execute('''DELETE FROM responses WHERE id IN
+                                   (SELECT id FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)''',
+                                (Config.RESPONSE_CACHE_MAX_ENTRIES,))
+    if cursor.rowcount > 0:
+        count_cache_event('evictions', cursor.rowcount)
+        connection.execute('''DELETE FROM search_pages WHERE name NOT IN (SELECT name FROM responses)''')
+
+
+def touch_response(connection: sqlite3.Connection, unique_name: str, accessed_at: float, now: float) -> None:
+    """Marks a response as recently used, unless that was done less than ACCESS_TOUCH_INTERVAL ago."""
+    if now - accessed_at > ACCESS_TOUCH_INTERVAL:
+        with connection:
+            connection.execute('''UPDATE responses SET accessed_at = ? WHERE name = ?''', (now, unique_name))
+
+
+def write_responses(entries: list[tuple[str, tuple]]) -> None:
+    """
+    Stores responses, slimmed and compressed, and the queries behind search pages in one transaction.
+    Responses received from spoonacular under content-addressed names are then published to the remote
+    cache backend, if there is one.
+    :param entries: (name, (recipes, created_at, (params, offset, total_results) or None, from remote backend))
+    """
     try:
-        connection = sqlite3.connect(db_path, check_same_thread=False)
-        cursor = connection.cursor()
-        cursor.execute('''SELECT id, name, json FROM responses''')
-        rows = cursor.fetchall()
-
-        names_list = []
-        for row in rows:
-            name = row[1]
-            names_list.append(name)
-
-        if unique_name in names_list:
-            # record with this name exists - update it
-            cursor.execute('''UPDATE responses SET json = ? WHERE name = ?''',
-                           (json.dumps(new_json_data), unique_name))
+        connection = get_connection()
+        with connection:
+            connection.executemany('''INSERT INTO responses (name, json, created_at, accessed_at) VALUES (?, ?, ?, ?)
+                                      ON CONFLICT (name) DO UPDATE SET json = excluded.json,
+                                      created_at = excluded.created_at, accessed_at = excluded.accessed_at''',
+                                   [(name, encode_recipes(entry[0]), entry[1], entry[1]) for name, entry in entries])
+            connection.executemany('''INSERT OR REPLACE INTO search_pages (name, params, page_offset, total_results)
+                                      VALUES (?, ?, ?, ?)''',
+                                   [(name, json.dumps(entry[2][0]), entry[2][1], entry[2][2])
+                                    for name, entry in entries if entry[2]])
+            evict_least_recently_used(connection)
+    except sqlite3.Error as e:
+        print(f"Database error while saving responses: {e}")
+    backend = get_remote_backend()
+    if backend is not None:
+        for name, (recipes, created_at, search_page, shared) in entries:
+            if not shared and is_content_addressed(name):
+                backend.set(f'response:{name}', {'recipes': recipe_documents(recipes), 'created_at': created_at,
+                                                 'search_page': search_page}, Config.RESPONSE_CACHE_TTL)
+
+
+def write_pending_responses() -> None:
+    """
+    Writer thread: stores queued responses in batches of up to WRITE_BEHIND_BATCH, one transaction per batch.
+    Responses queued while a batch is written are picked up together by the next one.
+    """
+    while True:
+        with pending_condition:
+            while not pending_writes and not writes_stopped:
+                pending_condition.wait()
+            if not pending_writes:
+                return
+            batch = list(islice(pending_writes.items(), Config.WRITE_BEHIND_BATCH))
+        try:
+            write_responses(batch)
+        except Exception as e:
+            # the batch is dropped rather than retried - the thread must survive to write the following ones
+            print(f"Database error while saving responses: {e}")
+        with pending_condition:
+            for name, entry in batch:
+                # a response queued again meanwhile waits for the next batch
+                if pending_writes.get(name) is entry:
+                    del pending_writes[name]
+            pending_condition.notify_all()
+
+
+def pass_response_to_database(unique_name: str, new_json_data: list, search_page: tuple | None = None,
+                              wait: bool = True) -> None:
+    """
+    Stores or updates an API response (list of recipes) in the database, slimmed and compressed.
+    :param search_page: (arguments of find_recipes, offset of the page, number of all results or None)
+        for a page of search results, see obtain_search_page
+    :param wait: write the response before returning, so that other workers can read it - e.g. the target
+        of a redirect, or a response waited for under a lease. With wait=False and RESPONSE_WRITE_BEHIND,
+        the response is queued for the writer thread of the process, which writes it in one transaction
+        with other responses queued meanwhile; until then, readers in the process get it from the queue.
+        Only for responses read by this process alone.
+    """
+    store_response(unique_name, (new_json_data, time.time(), search_page, False), wait)
+
+
+def store_response(unique_name: str, entry: tuple, wait: bool = False) -> None:
+    """
+    Writes a response right away, or queues it for the writer thread, see pass_response_to_database.
+    When WRITE_BEHIND_MAX_PENDING responses are queued already, it is written right away as well.
+    """
+    global writer_thread, writer_pid
+    with pending_condition:
+        queued = (not wait and Config.RESPONSE_WRITE_BEHIND and not writes_stopped
+                  and (unique_name in pending_writes or len(pending_writes) < Config.WRITE_BEHIND_MAX_PENDING))
+        if queued:
+            # threads don't survive fork, every worker starts its own writer - and a new one if it died
+            if writer_thread is None or writer_pid != os.getpid() or not writer_thread.is_alive():
+                writer_thread = threading.Thread(target=write_pending_responses, name='response-writer',
+                                                 daemon=True)
+                writer_thread.start()
+                writer_pid = os.getpid()
+            pending_writes[unique_name] = entry
+            pending_condition.notify()
         else:
-            cursor.execute('''INSERT INTO responses (NAME, json) VALUES (?, ?)''',
-                           (unique_name, json.dumps(new_json_data)))
-        connection.commit()
+            # an older version still queued must not overwrite this one later
+            pending_writes.pop(unique_name, None)
+    if not queued:
+        write_responses([(unique_name, entry)])
+
+
+def pending_response(unique_name: str) -> tuple | None:
+    """:return: (recipes, created_at, search page, ...) of a response queued by this process and not written yet"""
+    with pending_condition:
+        return pending_writes.get(unique_name)
+
+
+def shared_response(unique_name: str) -> tuple | None:
+    """
+    Looks up a response missing locally in the remote cache backend, where other hosts publish theirs.
+    A response found there is stored locally too, so it is looked up remotely only once per host.
+    :return: (recipes, created_at, search page, True) or None if there is no remote backend or no such response
+    """
+    backend = get_remote_backend()
+    if backend is None or not is_content_addressed(unique_name):
+        return None
+    value = backend.get(f'response:{unique_name}')
+    if value is None:
+        return None
+    search_page = tuple(value['search_page']) if value['search_page'] else None
+    entry = (LazyRecipes(value['recipes']), value['created_at'], search_page, True)
+    # not waited for - other workers find it remotely as well
+    store_response(unique_name, entry)
+    return entry
+
+
+def drain_pending_writes(timeout: float = 10) -> None:
+    """
+    Writes all queued responses before the worker exits. Responses passed later are written right away.
+    Registered with atexit and called by gunicorn's worker_exit hook.
+    """
+    global writes_stopped
+    with pending_condition:
+        writes_stopped = True
+        pending_condition.notify_all()
+        if writer_thread is not None and writer_pid == os.getpid() and writer_thread.is_alive():
+            pending_condition.wait_for(lambda: not pending_writes, timeout)
+        remaining = list(pending_writes.items())
+        pending_writes.clear()
+    if remaining:
+        write_responses(remaining)
+
+
+atexit.register(drain_pending_writes)
+
+
+def obtain_response_from_database(unique_name: str) -> list | None:
+    """
+    Retrieves a stored API response from the database, or from the write-behind queue of this process.
+    Recipes are decoded on access.
+    """
+    pending = pending_response(unique_name)
+    if pending is not None:
+        return pending[0]
+    try:
+        connection = get_connection()
+        row = connection.execute('''SELECT json, accessed_at FROM responses WHERE name = ?''',
+                                 (unique_name,)).fetchone()
+        if row is None:
+            shared = shared_response(unique_name)
+            return shared[0] if shared else None
+        touch_response(connection, unique_name, row[1], time.time())
+        return decode_recipes(row[0])
+    except sqlite3.Error as e:
+        print(f"Database error while retrieving response: {e}")
+        return None
+
+
+def obtain_search_page(unique_name: str) -> tuple[dict, int, int | None] | None:
+    """
+    Retrieves the query behind a stored page of search results.
+    :return: (arguments of find_recipes, offset of the page, number of all results or None),
+        None for responses that aren't search results
+    """
+    pending = pending_response(unique_name)
+    if pending is not None:
+        return pending[2]
+    try:
+        row = get_connection().execute('''SELECT params, page_offset, total_results FROM search_pages
+                                          WHERE name = ?''', (unique_name,)).fetchone()
+        if row is None:
+            shared = shared_response(unique_name)
+            return shared[2] if shared else None
+        return json.loads(row[0]), row[1], row[2]
     except sqlite3.Error as e:
-        print(f"Database error while saving response: {e}")
-    finally:
-        connection.close()
+        print(f"Database error while retrieving search page: {e}")
+        return None
 
 
-def obtain_response_from_database(unique_name: str) -> requests.models.Response | dict | list | None:
-    """Retrieves a stored API response from the database."""
-    connection = None
+def obtain_response_created_at(unique_name: str) -> float | None:
+    """
+    Retrieves the time a response was stored, which identifies its current version.
+    :return: timestamp or None if no response is stored under this name
+    """
+    pending = pending_response(unique_name)
+    if pending is not None:
+        return pending[1]
     try:
-        connection = sqlite3.connect(db_path, check_same_thread=False)
-        cursor = connection.cursor()
-        cursor.execute('''SELECT name, json FROM responses WHERE name = ?''', (unique_name,))
-        row = cursor.fetchone()
-        connection.commit()
-        connection.close()
-        return json.loads(row[1]) if row else None
+        row = get_connection().execute('''SELECT created_at FROM responses WHERE name = ?''',
+                                       (unique_name,)).fetchone()
+        if row is None:
+            shared = shared_response(unique_name)
+            return shared[1] if shared else None
+        return row[0]
     except sqlite3.Error as e:
         print(f"Database error while retrieving response: {e}")
         return None
-    finally:
-        connection.close()
+
+
+def obtain_cached_response(cache_key: str, count: bool = True, allow_stale: bool = False) -> list | None:
+    """
+    Retrieves a cached API response if it is younger than RESPONSE_CACHE_TTL, or of any age if allow_stale is True.
+    Counts a cache hit or miss, unless count is False.
+    :return: stored response or None if it is missing or expired
+    """
+    pending = pending_response(cache_key)
+    if pending is not None and (time.time() - pending[1] <= Config.RESPONSE_CACHE_TTL or allow_stale):
+        if count:
+            count_cache_event('hits')
+        return pending[0]
+    try:
+        connection = get_connection()
+        row = connection.execute('''SELECT json, created_at, accessed_at FROM responses WHERE name = ?''',
+                                 (cache_key,)).fetchone()
+        now = time.time()
+        if row is None:
+            shared = shared_response(cache_key)
+            if shared is not None and (now - shared[1] <= Config.RESPONSE_CACHE_TTL or allow_stale):
+                if count:
+                    count_cache_event('hits')
+                return shared[0]
+        if row is None or (now - row[1] > Config.RESPONSE_CACHE_TTL and not allow_stale):
+            if count:
+                count_cache_event('misses')
+            return None
+        touch_response(connection, cache_key, row[2], now)
+        if count:
+            count_cache_event('hits')
+        return decode_recipes(row[0])
+    except sqlite3.Error as e:
+        print(f"Database error while retrieving cached response: {e}")
+        if count:
+            count_cache_event('misses')
+        return None
+
+
+def cache_stats() -> dict:
+    """
+    Reports the state of the response cache.
+    :return: hits, misses and evictions of this process and the number of stored responses
+    """
+    with counters_lock:
+        stats = dict(cache_counters)
+    try:
+        stats['entries'] = get_connection().execute('''SELECT COUNT(*) FROM responses''').fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Database error while counting responses: {e}")
+        stats['entries'] = None
+    return stats
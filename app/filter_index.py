@@ -0,0 +1,115 @@
+import heapq
+import threading
+from .recipe_store import get_changed_recipes
+
+# diets of data.json and the names spoonacular uses for them in recipes
+DIET_ALIASES = {
+    'Gluten Free': ['gluten free'],
+    'Ketogenic': ['ketogenic'],
+    'Vegetarian': ['vegetarian', 'lacto ovo vegetarian'],
+    'Lacto-Vegetarian': ['lacto vegetarian'],
+    'Ovo-Vegetarian': ['ovo vegetarian'],
+    'Vegan': ['vegan'],
+    'Pescetarian': ['pescatarian', 'pescetarian'],
+    'Paleo': ['paleolithic', 'paleo'],
+    'Primal': ['primal'],
+    'Low FODMAP': ['fodmap friendly', 'low fodmap'],
+    'Whole30': ['whole 30', 'whole30'],
+}
+# intolerances of data.json which recipes reliably report, and the diet that excludes them
+# other intolerances can't be answered from the local store
+INTOLERANCE_FREE_DIETS = {
+    'Dairy': 'dairy free',
+    'Gluten': 'gluten free',
+    'Wheat': 'gluten free',
+}
+
+
+class FilterIndex:
+    """
+    In-memory index of cuisines and diets of the recipes in the local recipe store.
+    Every recipe gets a position, and every cuisine or diet a bitset (Python int) with the bits of its recipes set,
+    so any combination of filters is a few AND/OR operations over whole bitsets.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.positions = {}
+        self.recipe_ids = []
+        self.popularity = []
+        self.bitsets = {}
+
+    def refresh(self) -> None:
+        """Adds recipes ingested since the last refresh, replacing the bits of recipes that changed."""
+        with self.lock:
+            for recipe_id, version, popularity, cuisines, diets in get_changed_recipes(self.version):
+                position = self.positions.get(recipe_id)
+                if position is None:
+                    position = len(self.recipe_ids)
+                    self.positions[recipe_id] = position
+                    self.recipe_ids.append(recipe_id)
+                    self.popularity.append(popularity)
+                else:
+                    self.popularity[position] = popularity
+                    clear = ~(1 << position)
+                    for key in self.bitsets:
+                        self.bitsets[key] &= clear
+
+                bit = 1 << position
+                keys = [f'cuisine:{cuisine}' for cuisine in (cuisines or '').split('|') if cuisine]
+                keys += [f'diet:{diet}' for diet in (diets or '').split('|') if diet]
+                for key in keys:
+                    self.bitsets[key] = self.bitsets.get(key, 0) | bit
+                self.version = version
+
+    def any_of(self, keys: list[str]) -> int:
+        """:return: bitset of recipes having at least one of the keys"""
+        bitset = 0
+        for key in keys:
+            bitset |= self.bitsets.get(key, 0)
+        return bitset
+
+    def match(self, user_intolerances: list[str] = None, cuisine_type: list[str] = None,
+              diet_type: list[str] = None) -> int | None:
+        """
+        Combines the filters the way spoonacular does: a recipe matches any of the cuisines,
+        all the diets and is free of all the intolerances.
+        :return: bitset of matching recipes, None if a filter can't be answered locally
+        """
+        bitset = (1 << len(self.recipe_ids)) - 1
+        for intolerance in user_intolerances or []:
+            if intolerance not in INTOLERANCE_FREE_DIETS:
+                return None
+            bitset &= self.bitsets.get(f'diet:{INTOLERANCE_FREE_DIETS[intolerance]}', 0)
+        if cuisine_type:
+            bitset &= self.any_of([f'cuisine:{cuisine.lower()}' for cuisine in cuisine_type])
+        for diet in diet_type or []:
+            if diet not in DIET_ALIASES:
+                return None
+            bitset &= self.any_of([f'diet:{alias}' for alias in DIET_ALIASES[diet]])
+        return bitset
+
+    def filter_recipes(self, user_intolerances: list[str] = None, cuisine_type: list[str] = None,
+                       diet_type: list[str] = None, limit: int = 12) -> tuple[list[int], int] | None:
+        """
+        Finds the most popular locally known recipes matching the filters.
+        :return: (ids of up to limit recipes, number of all matches), None if a filter can't be answered locally
+        """
+        self.refresh()
+        with self.lock:
+            bitset = self.match(user_intolerances, cuisine_type, diet_type)
+            if bitset is None:
+                return None
+            positions = []
+            data = bitset.to_bytes((len(self.recipe_ids) + 7) // 8, 'little')
+            for byte_index, byte in enumerate(data):
+                if byte:
+                    for bit in range(8):
+                        if byte >> bit & 1:
+                            positions.append(byte_index * 8 + bit)
+            best = heapq.nlargest(limit, positions, key=self.popularity.__getitem__)
+            return [self.recipe_ids[position] for position in best], len(positions)
+
+
+filter_index = FilterIndex()
@@ -0,0 +1,58 @@
+import hashlib
+from typing import Callable
+from flask import current_app, render_template
+from markupsafe import Markup
+from .config import Config
+from .cache_backend import TieredCache
+
+# rendered fragments, in this process and in the shared cache backend
+fragments = TieredCache('fragment', Config.FRAGMENT_CACHE_MAX_ENTRIES, Config.FRAGMENT_CACHE_TTL)
+
+# digest of every template's source, computed once per process
+template_versions = {}
+
+
+def template_version(template_name: str) -> str:
+    """:return: short digest of the template source, so that changed templates never reuse old fragments"""
+    version = template_versions.get(template_name)
+    if version is None:
+        source = current_app.jinja_env.loader.get_source(current_app.jinja_env, template_name)[0]
+        version = template_versions[template_name] = hashlib.sha256(source.encode('utf-8')).hexdigest()[:12]
+    return version
+
+
+def fragment_key(template_name: str, identity: str) -> str:
+    """:return: key of a fragment: template, template version and identity of the rendered content"""
+    return f'{template_name}:{template_version(template_name)}:{identity}'
+
+
+def render_fragment(template_name: str, identity: str | None, build_context: Callable[[], dict]) -> Markup:
+    """
+    Renders a partial template, or reuses its earlier rendering for the same identity.
+    Fragments are looked up in memory, then in the shared cache backend, which other workers and hosts fill too.
+    :param identity: identifies the content of the context, e.g. a recipe id; None disables caching
+    :param build_context: returns the template context - only called when the fragment has to be rendered
+    :return: rendered HTML, safe to insert into another template
+    """
+    if identity is None:
+        return Markup(render_template(template_name, **build_context()))
+
+    key = fragment_key(template_name, identity)
+    html = fragments.get(key)
+    if html is None:
+        html = render_template(template_name, **build_context())
+        fragments.set(key, html, Config.FRAGMENT_CACHE_TTL)
+    return Markup(html)
+
+
+def page_etag(*parts) -> str:
+    """:return: entity tag of a page built from the given parts, e.g. fragment keys, user id and saved flag"""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+def fragment_stats() -> dict:
+    """
+    Reports the state of the fragment cache.
+    :return: hits in memory and in the shared backend, misses and the number of fragments in memory
+    """
+    return fragments.stats()
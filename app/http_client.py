@@ -0,0 +1,87 @@
+from .config import Config
+from .budget import check_budget, record_response, endpoint_name
+from .metrics import record_time, upstream_seconds
+from . import async_api
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect timeout, read timeout) in seconds for every spoonacular endpoint
+TIMEOUTS = {
+    'complexSearch': (Config.HTTP_CONNECT_TIMEOUT, Config.SEARCH_READ_TIMEOUT),
+    'random': (Config.HTTP_CONNECT_TIMEOUT, Config.RANDOM_READ_TIMEOUT),
+    'information': (Config.HTTP_CONNECT_TIMEOUT, Config.INFORMATION_READ_TIMEOUT),
+}
+DEFAULT_TIMEOUT = (Config.HTTP_CONNECT_TIMEOUT, Config.SEARCH_READ_TIMEOUT)
+
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+
+def create_session() -> requests.Session:
+    """
+    Creates an HTTP session with a keep-alive connection pool, bounded retries with jittered backoff
+    and headers shared by all spoonacular requests.
+    """
+    retry = Retry(
+        total=Config.HTTP_RETRIES,
+        backoff_factor=Config.HTTP_BACKOFF_FACTOR,
+        backoff_jitter=Config.HTTP_BACKOFF_FACTOR,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=['GET'],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=Config.HTTP_POOL_MAXSIZE, max_retries=retry)
+    new_session = requests.Session()
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    new_session.headers.update({'x-api-key': Config.API_KEY or '',
+                                'Accept': 'application/json',
+                                'Accept-Encoding': 'gzip, deflate'})
+    return new_session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the session of the current process.
+    A new session is created after fork, so gunicorn workers never share sockets with the master process.
+    """
+    global session, session_pid
+    pid = os.getpid()
+    if session is None or session_pid != pid:
+        with session_lock:
+            if session is None or session_pid != pid:
+                session = create_session()
+                session_pid = pid
+    return session
+
+
+def get(endpoint: str, params: dict) -> requests.models.Response:
+    """
+    Sends a GET request to a spoonacular recipes endpoint, e.g. 'complexSearch', 'random' or '123/information',
+    and records the quota points it cost and its duration.
+    With UPSTREAM_MODE=async the request is sent by the shared async client (see async_api).
+    :return: requests.Response
+    :raise BudgetExhausted: today's API budget doesn't allow the request
+    :raise requests.RequestException: connection failed, timed out or retries were exhausted
+    """
+    check_budget(endpoint, params)
+    url = f'{Config.SPOONACULAR_BASE_URL}/recipes/{endpoint}'
+    start = time.perf_counter()
+    try:
+        timeout = TIMEOUTS.get(endpoint_name(endpoint), DEFAULT_TIMEOUT)
+        if Config.UPSTREAM_MODE == 'async' and async_api.is_available():
+            response = async_api.send(url, params, timeout)
+        else:
+            response = get_session().get(url=url, params=params, timeout=timeout)
+    finally:
+        seconds = time.perf_counter() - start
+        record_time('upstream', seconds)
+        upstream_seconds.observe(seconds, endpoint_name(endpoint))
+    record_response(endpoint, params, response)
+    return response
@@ -0,0 +1,204 @@
+import hashlib
+import io
+import os
+import threading
+from urllib.parse import urlparse
+import requests
+from flask import current_app, url_for
+from .config import Config
+from .singleflight import single_flight
+
+try:
+    from PIL import Image, features
+except ImportError:  # without Pillow, photos are cached in their original size
+    Image = None
+
+# largest width and height of every variant - cards show 276px wide photos, the details page up to 636px
+IMAGE_VARIANTS = {'thumb': (312, 231), 'detail': (636, 424)}
+
+# photos are only proxied from spoonacular's CDN
+ALLOWED_IMAGE_HOSTS = ('spoonacular.com', 'img.spoonacular.com')
+
+# photos larger than this are not downloaded, the body is read in chunks of DOWNLOAD_CHUNK_BYTES
+MAX_SOURCE_BYTES = 5 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+EXTENSIONS = {'image/webp': '.webp', 'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif'}
+MIMETYPES = {extension: mimetype for mimetype, extension in EXTENSIONS.items()}
+
+# total size of the cached files, None until the cache directory is first scanned (per process)
+cache_size = None
+cache_lock = threading.Lock()
+
+image_session = None
+image_session_pid = None
+
+
+def is_allowed_image_url(url: str) -> bool:
+    """:return: True for https URLs on spoonacular's image hosts"""
+    parsed = urlparse(url)
+    return parsed.scheme == 'https' and parsed.hostname in ALLOWED_IMAGE_HOSTS
+
+
+def image_url(src: str | None, variant: str = 'thumb') -> str | None:
+    """
+    Template helper: the proxied URL of a dish photo.
+    :return: URL of the proxy route, or src itself if it isn't a spoonacular photo
+    """
+    if not src or not is_allowed_image_url(src):
+        return src
+    return url_for('main.image', variant=variant, src=src)
+
+
+def fetch_image(url: str) -> tuple[bytes, str]:
+    """
+    Downloads a photo with a keep-alive session of the current process.
+    The API key is not sent, the CDN doesn't need it. Photos larger than MAX_SOURCE_BYTES are rejected
+    by their Content-Length, or once that much of the body has arrived.
+    :return: content and content type
+    :raise requests.RequestException: the download failed or the photo is too large
+    """
+    global image_session, image_session_pid
+    if image_session is None or image_session_pid != os.getpid():
+        image_session = requests.Session()
+        image_session_pid = os.getpid()
+    with image_session.get(url, timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.IMAGE_READ_TIMEOUT),
+                           stream=True) as response:
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > MAX_SOURCE_BYTES:
+            raise requests.RequestException(f"Image too large: {url}")
+        content = bytearray()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            content += chunk
+            if len(content) > MAX_SOURCE_BYTES:
+                raise requests.RequestException(f"Image too large: {url}")
+        return bytes(content), response.headers.get('Content-Type', '').split(';')[0].strip()
+
+
+def resize(content: bytes, variant: str) -> tuple[bytes, str]:
+    """
+    Scales a photo down to the variant's size, as WebP if Pillow supports it, otherwise as JPEG.
+    :return: content and content type
+    """
+    with Image.open(io.BytesIO(content)) as image:
+        image = image.convert('RGB')
+        image.thumbnail(IMAGE_VARIANTS[variant])
+        output = io.BytesIO()
+        if features.check('webp'):
+            image.save(output, 'WEBP', quality=80, method=4)
+            return output.getvalue(), 'image/webp'
+        image.save(output, 'JPEG', quality=82, optimize=True, progressive=True)
+        return output.getvalue(), 'image/jpeg'
+
+
+def cache_path(variant: str, src: str) -> str:
+    """:return: path of a cached photo without the extension, which depends on the stored format"""
+    return os.path.join(Config.IMAGE_CACHE_DIR, variant, hashlib.sha256(src.encode('utf-8')).hexdigest())
+
+
+def find_cached_image(variant: str, src: str) -> tuple[str, str] | None:
+    """:return: path and content type of a cached photo, or None if it isn't cached"""
+    path = cache_path(variant, src)
+    for extension, mimetype in MIMETYPES.items():
+        if os.path.exists(path + extension):
+            return path + extension, mimetype
+    return None
+
+
+def scan_cache() -> list[tuple[float, int, str]]:
+    """:return: last access time, size and path of every cached photo"""
+    files = []
+    for variant in IMAGE_VARIANTS:
+        directory = os.path.join(Config.IMAGE_CACHE_DIR, variant)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            # files still being written by store_image aren't part of the cache yet
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+    return files
+
+
+def evict_images(added_bytes: int) -> None:
+    """
+    Counts a newly cached photo. Once the cache exceeds IMAGE_CACHE_MAX_BYTES, deletes the least recently
+    used photos until it is 10% below the limit.
+    """
+    global cache_size
+    with cache_lock:
+        if cache_size is None:
+            cache_size = sum(size for _, size, _ in scan_cache())
+        else:
+            cache_size += added_bytes
+        if cache_size <= Config.IMAGE_CACHE_MAX_BYTES:
+            return
+
+        # other workers write to the same directory, so the real size is taken from the files
+        files = sorted(scan_cache())
+        cache_size = sum(size for _, size, _ in files)
+        target = Config.IMAGE_CACHE_MAX_BYTES * 0.9
+        for _, size, path in files:
+            if cache_size <= target:
+                break
+            try:
+                os.remove(path)
+                cache_size -= size
+            except OSError:
+                pass
+
+
+def store_image(variant: str, src: str, content: bytes, mimetype: str) -> str:
+    """
+    Writes a photo to the cache. The file is replaced atomically, so readers never see half of it.
+    :return: path of the file
+    """
+    path = cache_path(variant, src) + EXTENSIONS[mimetype]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+    evict_images(len(content))
+    return path
+
+
+def cached_image(variant: str, src: str) -> tuple[str, str] | None:
+    """
+    Retrieves a variant of a dish photo from the cache, downloading and resizing it on the first request.
+    Concurrent first requests for the same photo, in this process or in other workers, share one download.
+    :return: path and content type of the cached file, or None if the photo couldn't be downloaded
+    """
+    cached = find_cached_image(variant, src)
+    if cached is not None:
+        return cached
+    fetcher = current_app.config['IMAGE_FETCHER']
+    return single_flight(f'image:{variant}:{os.path.basename(cache_path(variant, src))}',
+                         compute=lambda: download_image(variant, src, fetcher),
+                         lookup=lambda: find_cached_image(variant, src))
+
+
+def download_image(variant: str, src: str, fetcher) -> tuple[str, str] | None:
+    """
+    Downloads a photo with a fetcher (app.config['IMAGE_FETCHER']), resizes it and stores it in the cache.
+    :return: path and content type of the cached file, or None if the photo couldn't be downloaded
+    """
+    try:
+        content, mimetype = fetcher(src)
+    except requests.RequestException as e:
+        print(f"Image download error: {e}")
+        return None
+    if Image is not None:
+        try:
+            content, mimetype = resize(content, variant)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # not an image Pillow can read, or too many pixels to decode safely - keep the original
+            print(f"Image resize error: {e}")
+    if mimetype not in EXTENSIONS:
+        return None
+    try:
+        return store_image(variant, src, content, mimetype), mimetype
+    except OSError as e:
+        print(f"Image cache write error: {e}")
+        return None
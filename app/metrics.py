@@ -0,0 +1,241 @@
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from flask import Flask, g, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .config import Config
+
+# parts of a request whose time is measured separately
+COMPONENTS = ('upstream', 'sqlite', 'orm', 'template', 'session')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# {component: [seconds, calls]} of the request handled in the current context, None outside requests
+current_timings = ContextVar('current_timings', default=None)
+
+
+class Histogram:
+    """Prometheus-style histogram with cumulative buckets, one series per combination of label values."""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...], buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        """:return: lines of the histogram in the Prometheus text format"""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = format_labels(dict(zip(self.label_names, label_values)))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(dict(zip(self.label_names, label_values), le=str(bound)))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+request_seconds = Histogram('http_request_duration_seconds', 'Wall time of requests.',
+                            ('route', 'method', 'status'), LATENCY_BUCKETS)
+component_seconds = Histogram('http_request_component_seconds', 'Time of a request spent in one component.',
+                              ('route', 'component'), LATENCY_BUCKETS)
+component_calls = Histogram('http_request_component_calls',
+                            'Upstream requests, queries or renders of one component per request.',
+                            ('route', 'component'), COUNT_BUCKETS)
+upstream_seconds = Histogram('spoonacular_request_duration_seconds', 'Wall time of spoonacular requests.',
+                             ('endpoint',), LATENCY_BUCKETS)
+HISTOGRAMS = [request_seconds, component_seconds, component_calls, upstream_seconds]
+
+
+def record_time(component: str, seconds: float) -> None:
+    """Adds the time of one call to a component to the current request's timings."""
+    timings = current_timings.get()
+    if timings is not None:
+        entry = timings[component]
+        entry[0] += seconds
+        entry[1] += 1
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    SQLite connection that records the time of executed statements and commits as raw SQLite time.
+    Time spent fetching rows from a cursor after execute() is not included.
+    """
+
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            record_time('sqlite', time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            record_time('sqlite', time.perf_counter() - start)
+
+    def __exit__(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().__exit__(*args)
+        finally:
+            record_time('sqlite', time.perf_counter() - start)
+
+
+def start_orm_query(connection, cursor, statement, parameters, context, executemany) -> None:
+    # keyed by cursor, so that a failed statement can't leave its start behind for the next one
+    connection.info.setdefault('query_starts', {})[id(cursor)] = time.perf_counter()
+
+
+def finish_orm_query(connection, cursor, statement, parameters, context, executemany) -> None:
+    start = connection.info.get('query_starts', {}).pop(id(cursor), None)
+    if start is not None:
+        record_time('orm', time.perf_counter() - start)
+
+
+def forget_failed_orm_query(exception_context) -> None:
+    connection, context = exception_context.connection, exception_context.execution_context
+    if connection is not None and context is not None:
+        connection.info.get('query_starts', {}).pop(id(context.cursor), None)
+
+
+ORM_LISTENERS = [('before_cursor_execute', start_orm_query), ('after_cursor_execute', finish_orm_query),
+                 ('handle_error', forget_failed_orm_query)]
+
+
+def start_template(sender, template, context, **extra) -> None:
+    timings = current_timings.get()
+    if timings is not None:
+        timings['template_starts'].append(time.perf_counter())
+
+
+def finish_template(sender, template, context, **extra) -> None:
+    timings = current_timings.get()
+    if timings is not None and timings['template_starts']:
+        start = timings['template_starts'].pop()
+        # templates rendered while another one renders are part of its time
+        if not timings['template_starts']:
+            record_time('template', time.perf_counter() - start)
+
+
+def timed_session_method(method):
+    """Wraps a session interface method, so that its time is recorded as session time, whatever the backend."""
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record_time('session', time.perf_counter() - start)
+    return timed
+
+
+def server_timing(timings: dict, total: float) -> str:
+    """:return: Server-Timing header value: time and number of calls of every component used, and the total"""
+    entries = [f'{component};dur={timings[component][0] * 1000:.1f};desc="{timings[component][1]} calls"'
+               for component in COMPONENTS if timings[component][1]]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def init_metrics(app: Flask) -> None:
+    """
+    Measures every request when METRICS_ENABLED is set: wall time, and time and number of calls of upstream
+    requests, raw SQLite statements, ORM queries, template rendering and session loading and saving.
+    The times are added to the response as a Server-Timing header and to the histograms of /metrics.
+    """
+    if not Config.METRICS_ENABLED:
+        return
+    # listeners apply to every engine of the process - registered once, and only with metrics enabled
+    for name, listener in ORM_LISTENERS:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+    app.session_interface.open_session = timed_session_method(app.session_interface.open_session)
+    app.session_interface.save_session = timed_session_method(app.session_interface.save_session)
+    template_rendered.connect(finish_template, app)
+    before_render_template.connect(start_template, app)
+
+    @app.before_request
+    def start_request_timing():
+        # the session was opened before this runs, its time is kept by the context of the request
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = current_timings.get()
+        if timings is not None and 'request_started' in g:
+            response.headers['Server-Timing'] = server_timing(timings, time.perf_counter() - g.request_started)
+            g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe_request(error=None):
+        timings = current_timings.get()
+        if timings is None or 'request_started' not in g:
+            return
+        route = request.endpoint or 'unmatched'
+        status = g.get('response_status', 500)
+        request_seconds.observe(time.perf_counter() - g.request_started, route, request.method, str(status))
+        for component in COMPONENTS:
+            seconds, calls = timings[component]
+            component_seconds.observe(seconds, route, component)
+            component_calls.observe(calls, route, component)
+
+    wsgi_app = app.wsgi_app
+
+    def timed_wsgi_app(environ, start_response):
+        # every request gets fresh timings, which also cover opening the session before before_request
+        token = current_timings.set({**{component: [0.0, 0] for component in COMPONENTS}, 'template_starts': []})
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            current_timings.reset(token)
+
+    app.wsgi_app = timed_wsgi_app
+
+
+def render_metrics(samples: list[tuple[str, str, str, dict]]) -> str:
+    """
+    Renders the histograms and further samples in the Prometheus text format.
+    :param samples: (name, type, description, {labels as a tuple of (name, value) pairs: value})
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, metric_type, description, values in samples:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in values.items():
+            lines.append(f'{name}{format_labels(dict(labels))} {value}')
+    return '\n'.join(lines) + '\n'
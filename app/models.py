@@ -1,6 +1,17 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, ForeignKey, Table, Column, JSON
+from sqlalchemy import (Integer, String, ForeignKey, Table, Column, JSON, Index, MetaData, select, delete, update,
+                        inspect, text, event)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import IntegrityError
+from flask import g
 from flask_login import UserMixin, current_user
+from collections import OrderedDict
+import json
+import threading
+from .config import Config
+from .recipe_store import find_local_recipe_ids_by_title
+from .cache_backend import TieredCache
 
 
 class Base(DeclarativeBase):
@@ -12,6 +23,10 @@ class Base(DeclarativeBase):
 from .extensions import sqlalchemy_db
 
 
+# width of the password column, room for the hashes of every method werkzeug offers
+PASSWORD_HASH_MAX_LENGTH = 256
+
+
 # Association Table (User - Recipe)
 saved_recipes = Table(
     'saved_recipes',
@@ -26,7 +41,8 @@ class User(UserMixin, sqlalchemy_db.Model):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    # salted hash - 102 characters with the default pbkdf2:sha256:600000, 162 with scrypt
+    password: Mapped[str] = mapped_column(String(PASSWORD_HASH_MAX_LENGTH))
     name: Mapped[str] = mapped_column(String(100))
 
     # Many-to-Many Relationship: User <-> Saved Recipes
@@ -45,11 +61,17 @@ class User(UserMixin, sqlalchemy_db.Model):
 
 
 class Recipe(sqlalchemy_db.Model):
-    """Recipe model representing a saved recipe."""
+    """Recipe model representing a saved recipe, identified by its spoonacular id."""
     __tablename__ = 'recipes'
+    __table_args__ = (
+        Index('ix_recipes_spoonacular_id', 'spoonacular_id', unique=True),
+        Index('ix_recipes_dish_name', 'dish_name'),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    dish_name: Mapped[String] = mapped_column(String, nullable=False, unique=True)
+    # null only for recipes saved before spoonacular ids were stored, which couldn't be matched during migration
+    spoonacular_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    dish_name: Mapped[String] = mapped_column(String, nullable=False)
     dish_photo: Mapped[String] = mapped_column(String, nullable=True)
     instructions: Mapped[JSON] = mapped_column(JSON, nullable=False)
     ingredients: Mapped[JSON] = mapped_column(JSON, nullable=False)
@@ -65,22 +87,232 @@ class Recipe(sqlalchemy_db.Model):
     @classmethod
     def get_id_by_name(cls, name: str) -> int | None:
         """Retrieves recipe id from database by name (if exists)."""
-        recipe = cls.query.filter_by(dish_name=name).first()
-        return recipe.id if recipe else None
+        return sqlalchemy_db.session.execute(select(cls.id).where(cls.dish_name == name).limit(1)).scalar()
+
+    @classmethod
+    def get_id_by_spoonacular_id(cls, spoonacular_id: int) -> int | None:
+        """
+        Retrieves recipe id from database by its spoonacular id (if exists).
+        Found ids are remembered, recipes are never deleted, so they stay valid.
+        """
+        with recipe_ids_lock:
+            recipe_id = recipe_ids.get(spoonacular_id)
+            if recipe_id is not None:
+                recipe_ids.move_to_end(spoonacular_id)
+                return recipe_id
+        recipe_id = sqlalchemy_db.session.execute(
+            select(cls.id).where(cls.spoonacular_id == spoonacular_id)).scalar()
+        if recipe_id is not None:
+            remember_recipe_id(spoonacular_id, recipe_id)
+        return recipe_id
+
+    @classmethod
+    def get_id_for_recipe(cls, recipe: 'RecipeSummary') -> int | None:
+        """Retrieves recipe id from database by spoonacular id, or by name for recipes without one."""
+        if recipe.id is not None:
+            return cls.get_id_by_spoonacular_id(recipe.id)
+        return cls.get_id_by_name(recipe.title)
 
     @classmethod
-    def add_new_recipe(cls, dish_name: str, dish_photo: str, instructions: JSON | str, ingredients: JSON | str) \
-            -> 'Recipe':
-        """Adds a new recipe to the database."""
+    def add_new_recipe(cls, recipe: 'RecipeDetail') -> int:
+        """
+        Adds a new recipe to the database. If another request has just added the same recipe,
+        the id of that one is returned.
+        :return: id of the new recipe
+        """
         new_recipe = cls(
-            dish_name=dish_name,
-            dish_photo=dish_photo,
-            instructions=instructions,
-            ingredients=ingredients,
+            spoonacular_id=recipe.id,
+            dish_name=recipe.title,
+            dish_photo=recipe.image,
+            instructions=json.dumps(recipe.instructions),
+            ingredients=json.dumps(recipe.ingredients),
         )
-        sqlalchemy_db.session.add(new_recipe)
-        sqlalchemy_db.session.commit()
-        return new_recipe
+        try:
+            sqlalchemy_db.session.add(new_recipe)
+            sqlalchemy_db.session.flush()
+            recipe_id = new_recipe.id
+            sqlalchemy_db.session.commit()
+        except IntegrityError:
+            # concurrent first saves of a recipe - the unique index on spoonacular_id lets only one in
+            sqlalchemy_db.session.rollback()
+            recipe_id = cls.get_id_by_spoonacular_id(recipe.id) if recipe.id is not None else None
+            if recipe_id is None:
+                raise
+            return recipe_id
+        if recipe.id is not None:
+            remember_recipe_id(recipe.id, recipe_id)
+        return recipe_id
+
+
+# spoonacular id -> Recipe.id of recently used recipes (per process)
+RECIPE_IDS_LIMIT = 4096
+recipe_ids = OrderedDict()
+recipe_ids_lock = threading.Lock()
+
+
+def remember_recipe_id(spoonacular_id: int, recipe_id: int) -> None:
+    """Caches the id of a recipe, evicting the least recently used ids above RECIPE_IDS_LIMIT."""
+    with recipe_ids_lock:
+        recipe_ids[spoonacular_id] = recipe_id
+        recipe_ids.move_to_end(spoonacular_id)
+        while len(recipe_ids) > RECIPE_IDS_LIMIT:
+            recipe_ids.popitem(last=False)
+
+
+class CachedUser:
+    """
+    User as seen by Flask-Login on every request: id, email and name, without the password hash.
+    Implements the attributes Flask-Login expects from a user, like UserMixin.
+    """
+    __slots__ = ('id', 'email', 'name')
+
+    def __init__(self, id: int, email: str, name: str):
+        self.id = id
+        self.email = email
+        self.name = name
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def get_id(self) -> str:
+        return str(self.id)
+
+
+# id, email and name of recently active users by user id, in this process and in the shared cache backend
+cached_users = TieredCache('user', Config.USER_CACHE_MAX_ENTRIES, Config.CACHE_LOCAL_TTL)
+
+# how often the user loader was answered from the cache and from the database (per process)
+user_loader_counters = {'cache_hits': 0, 'db_hits': 0}
+user_loader_counters_lock = threading.Lock()
+
+
+def load_cached_user(user_id: str) -> CachedUser | None:
+    """
+    Loads the user of a session for Flask-Login. Users are cached for USER_CACHE_TTL seconds; changes made
+    through other workers are visible after at most that long, or CACHE_LOCAL_TTL with a shared cache backend.
+    :return: CachedUser or None if no such user exists
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    cached = cached_users.get(str(user_id))
+    if cached is not None:
+        with user_loader_counters_lock:
+            user_loader_counters['cache_hits'] += 1
+        return CachedUser(cached['id'], cached['email'], cached['name'])
+
+    row = sqlalchemy_db.session.execute(select(User.id, User.email, User.name).where(User.id == user_id)).first()
+    with user_loader_counters_lock:
+        user_loader_counters['db_hits'] += 1
+    if row is None:
+        return None
+    cached_users.set(str(user_id), {'id': row.id, 'email': row.email, 'name': row.name}, Config.USER_CACHE_TTL)
+    return CachedUser(row.id, row.email, row.name)
+
+
+def invalidate_cached_user(user_id: int) -> None:
+    """Drops a user from the shared cache and the cache of this process, so that it is loaded from the database."""
+    cached_users.delete(str(user_id))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_changed_user(mapper, connection, target: User) -> None:
+    """Invalidates users changed through the ORM."""
+    invalidate_cached_user(target.id)
+
+
+def migrate_recipes_table() -> None:
+    """
+    Brings a recipes table created by older versions up to date: adds the spoonacular_id column and its index,
+    removes the unique constraint on dish_name and fills spoonacular ids of existing recipes
+    whose titles are known to the local recipe store. Must run in an application context.
+    """
+    engine = sqlalchemy_db.engine
+    inspector = inspect(engine)
+    columns = [column['name'] for column in inspector.get_columns('recipes')]
+    unique_on_name = [constraint.get('name') for constraint in inspector.get_unique_constraints('recipes')
+                      if constraint['column_names'] == ['dish_name']]
+    unique_on_name += [index['name'] for index in inspector.get_indexes('recipes')
+                       if index['unique'] and index['column_names'] == ['dish_name']]
+
+    with engine.begin() as connection:
+        if unique_on_name and engine.dialect.name == 'sqlite':
+            # SQLite can't drop a constraint - rebuild the table
+            migrated = Recipe.__table__.to_metadata(MetaData(), name='recipes_migrated')
+            migrated.create(connection)
+            spoonacular_id = 'spoonacular_id' if 'spoonacular_id' in columns else 'NULL'
+            connection.execute(text(f'''INSERT INTO recipes_migrated
+                                         (id, spoonacular_id, dish_name, dish_photo, instructions, ingredients)
+                                         SELECT id, {spoonacular_id}, dish_name, dish_photo, instructions, ingredients
+                                         FROM recipes'''))
+            connection.execute(text('''DROP TABLE recipes'''))
+            connection.execute(text('''ALTER TABLE recipes_migrated RENAME TO recipes'''))
+        else:
+            for name in unique_on_name:
+                if name:
+                    connection.execute(text(f'ALTER TABLE recipes DROP CONSTRAINT "{name}"'))
+            if 'spoonacular_id' not in columns:
+                connection.execute(text('''ALTER TABLE recipes ADD COLUMN spoonacular_id INTEGER'''))
+                for index in Recipe.__table__.indexes:
+                    index.create(connection, checkfirst=True)
+
+        titles = connection.execute(select(Recipe.dish_name).where(Recipe.spoonacular_id.is_(None))).scalars().all()
+        for title, spoonacular_id in find_local_recipe_ids_by_title(titles).items():
+            connection.execute(update(Recipe).where(Recipe.dish_name == title, Recipe.spoonacular_id.is_(None))
+                               .values(spoonacular_id=spoonacular_id))
+
+
+def migrate_users_table() -> None:
+    """
+    Widens the password column of a users table created by older versions, which is too narrow for the hashes
+    of the default hashing method. SQLite ignores the length, other databases reject longer hashes.
+    Must run in an application context.
+    """
+    engine = sqlalchemy_db.engine
+    if engine.dialect.name == 'sqlite':
+        return
+    column = next(column for column in inspect(engine).get_columns('users') if column['name'] == 'password')
+    if column['type'].length is None or column['type'].length >= PASSWORD_HASH_MAX_LENGTH:
+        return
+    column_type = f'VARCHAR({PASSWORD_HASH_MAX_LENGTH})'
+    with engine.begin() as connection:
+        if engine.dialect.name in ('mysql', 'mariadb'):
+            # MODIFY redefines the whole column
+            not_null = '' if column['nullable'] else ' NOT NULL'
+            connection.execute(text(f'ALTER TABLE users MODIFY password {column_type}{not_null}'))
+        else:
+            connection.execute(text(f'ALTER TABLE users ALTER COLUMN password TYPE {column_type}'))
+
+
+def insert_ignoring_duplicates(table: Table):
+    """
+    Builds an INSERT which does nothing if the row already exists, in the SQL dialect of the database.
+    :return: insert statement, or None if the dialect has no such clause
+    """
+    dialect = sqlalchemy_db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return None
+
+
+def saved_recipe_ids() -> set[int]:
+    """
+    Returns ids of the recipes saved by the current user.
+    They are loaded with one query per request and kept up to date by save/unsave.
+    Visitors who aren't logged in have no saved recipes.
+    """
+    if not current_user.is_authenticated:
+        return set()
+    if 'saved_recipe_ids' not in g:
+        rows = sqlalchemy_db.session.execute(
+            select(saved_recipes.c.recipe_id).where(saved_recipes.c.user_id == current_user.id))
+        g.saved_recipe_ids = set(rows.scalars())
+    return g.saved_recipe_ids
 
 
 def is_recipe_saved_by_user(recipe_id: int) -> bool:
@@ -89,18 +321,48 @@ def is_recipe_saved_by_user(recipe_id: int) -> bool:
     :return: True: recipe is saved by the current user,
         False: recipe isn't saved by the current user
     """
-    return bool(current_user.saved.filter_by(id=recipe_id).first())
+    return recipe_id in saved_recipe_ids()
 
 
-def save_recipe_for_current_user(recipe: 'Recipe') -> None:
-    """Adds a recipe to the current user's saved recipes."""
-    if not current_user.saved.filter_by(id=recipe.id).first():
-        current_user.saved.append(recipe)
+def save_recipe_for_current_user(recipe_id: int) -> None:
+    """Adds a recipe to the current user's saved recipes. Saving an already saved recipe changes nothing."""
+    values = {'user_id': current_user.id, 'recipe_id': recipe_id}
+    statement = insert_ignoring_duplicates(saved_recipes)
+    try:
+        if statement is not None:
+            sqlalchemy_db.session.execute(statement, values)
+        else:
+            sqlalchemy_db.session.execute(saved_recipes.insert(), values)
         sqlalchemy_db.session.commit()
+    except IntegrityError:
+        # recipe already saved - only possible without the dialect's "on conflict do nothing"
+        sqlalchemy_db.session.rollback()
+    if 'saved_recipe_ids' in g:
+        g.saved_recipe_ids.add(recipe_id)
 
 
-def unsave_recipe_for_current_user(recipe: 'Recipe') -> None:
+def unsave_recipe_for_current_user(recipe_id: int) -> None:
     """Removes a recipe from the current user's saved recipes."""
-    if current_user.saved.filter_by(id=recipe.id).first():
-        current_user.saved.remove(recipe)
-        sqlalchemy_db.session.commit()
+    sqlalchemy_db.session.execute(
+        delete(saved_recipes).where(saved_recipes.c.user_id == current_user.id,
+                                    saved_recipes.c.recipe_id == recipe_id))
+    sqlalchemy_db.session.commit()
+    if 'saved_recipe_ids' in g:
+        g.saved_recipe_ids.discard(recipe_id)
+
+
+def saved_recipe_cards(after_recipe_id: int | None, limit: int) -> tuple[list, int | None]:
+    """
+    Retrieves one page of the current user's saved recipes, with only the columns shown on cards.
+    Pages are ordered by recipe id, newest first, and continue after the last id of the previous page.
+    :return: rows with id, dish_name and dish_photo, and the id to continue after (None on the last page)
+    """
+    query = (select(Recipe.id, Recipe.dish_name, Recipe.dish_photo)
+             .join(saved_recipes, saved_recipes.c.recipe_id == Recipe.id)
+             .where(saved_recipes.c.user_id == current_user.id))
+    if after_recipe_id is not None:
+        query = query.where(saved_recipes.c.recipe_id < after_recipe_id)
+    rows = sqlalchemy_db.session.execute(query.order_by(saved_recipes.c.recipe_id.desc()).limit(limit + 1)).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+from .config import Config
+
+# time spent on password hashing (per process): operations, rejections, seconds in the pool and waiting for it
+hashing_stats = {operation: {'count': 0, 'rejected': 0, 'compute_seconds': 0.0, 'wait_seconds': 0.0,
+                             'max_seconds': 0.0}
+                 for operation in ['hash', 'verify']}
+stats_lock = threading.Lock()
+
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+# hashes submitted by this process and not finished yet, at most PASSWORD_HASH_MAX_PENDING
+pending_slots = None
+# process whose pool broke - it hashes on the calling thread from then on, as forking a new pool while other
+# threads run could leave the children with locks that are never released
+broken_pool_pid = None
+
+
+class HashingBusy(ServiceUnavailable):
+    """Raised instead of queueing a password hash when PASSWORD_HASH_MAX_PENDING hashes are already waiting."""
+    description = "Too many logins at once, please try again in a moment."
+
+
+def hash_in_worker(password: str, method: str, salt_length: int) -> tuple[str, float]:
+    """Runs in the pool. :return: salted hash of the password and seconds it took"""
+    start = time.perf_counter()
+    password_hash = generate_password_hash(password, method=method, salt_length=salt_length)
+    return password_hash, time.perf_counter() - start
+
+
+def verify_in_worker(password_hash: str, password: str) -> tuple[bool, float]:
+    """Runs in the pool. :return: whether the password matches the hash and seconds it took"""
+    start = time.perf_counter()
+    matches = check_password_hash(password_hash, password)
+    return matches, time.perf_counter() - start
+
+
+def get_executor() -> ProcessPoolExecutor | None:
+    """
+    Returns the hashing pool of the current process, creating it on first use and after fork.
+    :return: pool or None if the pool of this process broke
+    """
+    global executor, executor_pid, pending_slots
+    pid = os.getpid()
+    if broken_pool_pid == pid:
+        return None
+    if executor is None or executor_pid != pid:
+        with executor_lock:
+            if executor is None or executor_pid != pid:
+                executor = ProcessPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS,
+                                               mp_context=multiprocessing.get_context('fork'))
+                pending_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_MAX_PENDING)
+                executor_pid = pid
+    return executor
+
+
+def start_hashing_pool() -> None:
+    """
+    Forks the pool's processes right away. Called while the app is created, before other threads start,
+    so the processes never inherit locks held by them. Spawned processes would import main.py and create
+    another app each.
+    """
+    get_executor().submit(time.time).result()
+
+
+def abandon_broken_pool(pool: ProcessPoolExecutor) -> None:
+    """Shuts down a pool whose process died. Later hashes of this process are computed on the calling thread."""
+    global broken_pool_pid
+    with executor_lock:
+        if executor is pool:
+            broken_pool_pid = executor_pid
+            print("Password hashing pool broke, hashing on request threads from now on")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_pool(operation: str, function, *args):
+    """
+    Runs a hashing function in the pool and records its timing. Once the pool broke, runs it on the calling thread.
+    :raise HashingBusy: the pool's queue is full, or the hash didn't finish within PASSWORD_HASH_TIMEOUT
+    """
+    pool = get_executor()
+    slots = pending_slots
+    if not slots.acquire(blocking=False):
+        with stats_lock:
+            hashing_stats[operation]['rejected'] += 1
+        raise HashingBusy()
+    start = time.perf_counter()
+    if pool is None:
+        try:
+            result, compute_seconds = function(*args)
+        finally:
+            slots.release()
+        record_hashing(operation, compute_seconds, time.perf_counter() - start)
+        return result
+    try:
+        future = pool.submit(function, *args)
+    except BrokenProcessPool:
+        slots.release()
+        abandon_broken_pool(pool)
+        return run_in_pool(operation, function, *args)
+    # the slot is held until the hash has really finished - a running hash can't be cancelled on timeout
+    future.add_done_callback(lambda done: slots.release())
+    try:
+        result, compute_seconds = future.result(timeout=Config.PASSWORD_HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        with stats_lock:
+            hashing_stats[operation]['rejected'] += 1
+        raise HashingBusy()
+    except BrokenProcessPool:
+        abandon_broken_pool(pool)
+        return run_in_pool(operation, function, *args)
+    record_hashing(operation, compute_seconds, time.perf_counter() - start)
+    return result
+
+
+def record_hashing(operation: str, compute_seconds: float, total_seconds: float) -> None:
+    """Adds a finished hash to hashing_stats."""
+    with stats_lock:
+        stats = hashing_stats[operation]
+        stats['count'] += 1
+        stats['compute_seconds'] += compute_seconds
+        stats['wait_seconds'] += total_seconds - compute_seconds
+        stats['max_seconds'] = max(stats['max_seconds'], total_seconds)
+
+
+def hash_password(password: str) -> str:
+    """:return: salted hash of the password with PASSWORD_HASH_METHOD, computed in the pool"""
+    return run_in_pool('hash', hash_in_worker, password, Config.PASSWORD_HASH_METHOD, Config.PASSWORD_SALT_LENGTH)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """:return: True if the password matches the stored hash, checked in the pool"""
+    return run_in_pool('verify', verify_in_worker, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """:return: True if the hash was made with another method, work factor or salt length than configured now"""
+    method, _, rest = password_hash.partition('$')
+    salt = rest.partition('$')[0]
+    return method != Config.PASSWORD_HASH_METHOD or len(salt) != Config.PASSWORD_SALT_LENGTH
@@ -0,0 +1,101 @@
+import json
+import zlib
+from collections.abc import Sequence
+
+# first byte of every encoded payload - stored values without it are plain JSON text of older versions
+FORMAT_VERSION = b'\x01'
+COMPRESSION_LEVEL = 6
+
+# recipe fields used by the templates, the recipe store and the filter index - the rest is dropped before storage
+RECIPE_FIELDS = ['id', 'title', 'image', 'cuisines', 'diets', 'vegan', 'vegetarian', 'glutenFree', 'dairyFree',
+                 'aggregateLikes']
+
+
+def slim_recipe(recipe: dict) -> dict:
+    """
+    Projects a spoonacular recipe down to the fields the app renders or indexes:
+    RECIPE_FIELDS, steps of the first instruction with ingredient names, and original ingredient lines.
+    """
+    slim = {field: recipe[field] for field in RECIPE_FIELDS if field in recipe}
+    if 'analyzedInstructions' in recipe:
+        slim['analyzedInstructions'] = []
+        if recipe['analyzedInstructions']:
+            steps = [{'number': step.get('number'), 'step': step.get('step', ''),
+                      'ingredients': [{'name': ingredient['name']} for ingredient in step.get('ingredients', [])]}
+                     for step in recipe['analyzedInstructions'][0].get('steps', [])]
+            slim['analyzedInstructions'].append({'steps': steps})
+    if 'extendedIngredients' in recipe:
+        slim['extendedIngredients'] = [{'original': ingredient.get('original'), 'name': ingredient.get('name')}
+                                       for ingredient in recipe['extendedIngredients']]
+    return slim
+
+
+def is_complete_recipe(recipe: dict) -> bool:
+    """
+    :return: True if the recipe carries instructions or ingredient lines (possibly empty),
+        False for lean search results, which only have an id, a title and a photo
+    """
+    return 'analyzedInstructions' in recipe or 'extendedIngredients' in recipe
+
+
+def compress(data) -> bytes:
+    """:return: versioned, zlib-compressed compact JSON of the data"""
+    encoded = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return FORMAT_VERSION + zlib.compress(encoded, COMPRESSION_LEVEL)
+
+
+def decompress(value: bytes | str):
+    """:return: data stored with compress(), or parsed JSON text stored by older versions"""
+    if isinstance(value, str):
+        return json.loads(value)
+    if value[:1] != FORMAT_VERSION:
+        raise ValueError(f"Unknown payload format version: {value[:1]!r}")
+    return json.loads(zlib.decompress(value[1:]))
+
+
+class LazyRecipes(Sequence):
+    """List of recipes decoded from storage, parsing each recipe's JSON only when it is accessed."""
+
+    def __init__(self, encoded_recipes: list[str]):
+        self.encoded_recipes = encoded_recipes
+        self.decoded = [None] * len(encoded_recipes)
+
+    def __len__(self) -> int:
+        return len(self.encoded_recipes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self.decoded[index] is None:
+            self.decoded[index] = json.loads(self.encoded_recipes[index])
+        return self.decoded[index]
+
+
+def recipe_documents(recipes: list) -> list[str]:
+    """:return: JSON document of every recipe, slimmed - recipes decoded from storage keep their documents"""
+    if isinstance(recipes, LazyRecipes):
+        return recipes.encoded_recipes
+    return [json.dumps(slim_recipe(recipe) if isinstance(recipe, dict) else recipe, separators=(',', ':'))
+            for recipe in recipes]
+
+
+def encode_recipes(recipes: list) -> bytes:
+    """Encodes a list of recipes for storage: every recipe is slimmed and kept as a separate JSON document."""
+    return compress(recipe_documents(recipes))
+
+
+def decode_recipes(value: bytes | str) -> LazyRecipes | list:
+    """:return: recipes stored with encode_recipes(), or the parsed JSON text of older versions"""
+    if isinstance(value, str):
+        return json.loads(value)
+    return LazyRecipes(decompress(value))
+
+
+def encode_recipe(recipe: dict) -> bytes:
+    """Encodes a single slimmed recipe for storage."""
+    return compress(slim_recipe(recipe))
+
+
+def decode_recipe(value: bytes | str) -> dict:
+    """:return: recipe stored with encode_recipe(), or the parsed JSON text of older versions"""
+    return decompress(value)
@@ -0,0 +1,145 @@
+from .config import Config
+from .api import get_random_recipes
+from .recipe_store import ingest_recipes, get_random_local_recipes
+from .budget import budget_mode, NORMAL, PREFER_LOCAL
+from .singleflight import single_flight
+from bisect import bisect_left
+from werkzeug.exceptions import InternalServerError
+import random
+import threading
+import time
+
+# random recipes to be shown, oldest first: list of (fetch time, recipe)
+pool = []
+pool_ids = set()
+pool_lock = threading.Lock()
+refill_lock = threading.Lock()
+
+# seconds to wait before refilling again after a refill failed
+REFILL_RETRY_INTERVAL = 60
+next_refill_at = 0.0
+
+
+def add_recipes_to_pool(recipes: list[dict]) -> None:
+    """Adds fetched recipes to the pool, skipping duplicates. Above RANDOM_POOL_SIZE, the oldest ones are dropped."""
+    fetched_at = time.time()
+    with pool_lock:
+        for recipe in recipes:
+            if recipe.get('id') in pool_ids:
+                continue
+            pool.append((fetched_at, recipe))
+            pool_ids.add(recipe.get('id'))
+        while len(pool) > Config.RANDOM_POOL_SIZE:
+            pool_ids.discard(pool.pop(0)[1].get('id'))
+
+
+def first_fresh_index() -> int:
+    """:return: index of the first recipe of the pool not older than RANDOM_POOL_MAX_AGE (called with the lock held)"""
+    return bisect_left(pool, time.time() - Config.RANDOM_POOL_MAX_AGE, key=lambda entry: entry[0])
+
+
+def count_fresh_recipes() -> int:
+    """:return: number of recipes in the pool not older than RANDOM_POOL_MAX_AGE"""
+    with pool_lock:
+        return len(pool) - first_fresh_index()
+
+
+def retire_stale_recipes() -> None:
+    """Drops recipes older than RANDOM_POOL_MAX_AGE from the pool."""
+    with pool_lock:
+        index = first_fresh_index()
+        for fetched_at, recipe in pool[:index]:
+            pool_ids.discard(recipe.get('id'))
+        del pool[:index]
+
+
+def fetch_batch() -> bool:
+    """
+    Fetches one batch of RANDOM_POOL_BATCH random recipes from the API into the pool.
+    :return: True if any recipes were fetched
+    """
+    response = get_random_recipes(num_recipes=Config.RANDOM_POOL_BATCH)
+    if response == 1:
+        return False
+    recipes = response.json()['recipes']
+    add_recipes_to_pool(recipes)
+    ingest_recipes(recipes)
+    return True
+
+
+def refill_pool() -> None:
+    """
+    Fetches batches until the pool holds RANDOM_POOL_SIZE fresh recipes, then retires the stale ones,
+    which are shown meanwhile. Only one refill runs at a time, requests never wait for it.
+    """
+    global next_refill_at
+    if not refill_lock.acquire(blocking=False):
+        return
+    try:
+        fresh = count_fresh_recipes()
+        while fresh < Config.RANDOM_POOL_SIZE:
+            if not fetch_batch() or count_fresh_recipes() == fresh:
+                break
+            fresh = count_fresh_recipes()
+        if fresh >= Config.RANDOM_POOL_LOW_WATER:
+            retire_stale_recipes()
+        else:
+            next_refill_at = time.time() + REFILL_RETRY_INTERVAL
+    except Exception as e:
+        next_refill_at = time.time() + REFILL_RETRY_INTERVAL
+        print(f"Random recipe pool refill error: {e}")
+    finally:
+        refill_lock.release()
+
+
+def start_refill() -> None:
+    """
+    Refills the pool in a background thread, unless a refill is already running or failed a moment ago.
+    Only while the API budget is in normal or prefer_local mode - below, the pool's stale recipes are shown.
+    """
+    if refill_lock.locked() or time.time() < next_refill_at or budget_mode() not in [NORMAL, PREFER_LOCAL]:
+        return
+    threading.Thread(target=refill_pool, name='random-pool-refill', daemon=True).start()
+
+
+def sample_pool(num_recipes: int) -> list[dict]:
+    """
+    Picks random recipes from the pool without removing them. Stale recipes are picked only when there aren't
+    enough fresh ones - they stay in the pool until a refill replaces them.
+    :return: up to num_recipes distinct recipes
+    """
+    with pool_lock:
+        first_fresh = first_fresh_index()
+        indexes = random.sample(range(first_fresh, len(pool)), min(num_recipes, len(pool) - first_fresh))
+        indexes += random.sample(range(first_fresh), min(num_recipes - len(indexes), first_fresh))
+        return [pool[index][1] for index in indexes]
+
+
+def take_random_recipes(num_recipes: int) -> list[dict] | None:
+    """
+    Picks a given number of random recipes from the pool, which is refilled in the background once it holds
+    fewer than RANDOM_POOL_LOW_WATER fresh recipes. Requests never wait for a refill: recipes missing
+    from the pool are picked from the local recipe store. Only when both are empty (cold start of an empty store),
+    one batch is fetched right away, shared by concurrent visitors.
+    :return: list of recipes or None if no recipes are available
+    """
+    recipes = sample_pool(num_recipes)
+    if not recipes and budget_mode() in [NORMAL, PREFER_LOCAL] and not get_random_local_recipes(1):
+        def recipes_available() -> bool | None:
+            # a batch fetched by another worker reaches this one through the local recipe store
+            return bool(pool or get_random_local_recipes(1)) or None
+
+        try:
+            single_flight('random-pool-cold-start', compute=lambda: fetch_batch() or None, lookup=recipes_available)
+        except InternalServerError as e:  # includes BudgetExhausted
+            print(f"Random recipe pool error: {e.description}")
+        recipes = sample_pool(num_recipes)
+
+    if count_fresh_recipes() < Config.RANDOM_POOL_LOW_WATER:
+        start_refill()
+
+    if len(recipes) < num_recipes:
+        shown_ids = {recipe.get('id') for recipe in recipes}
+        recipes += [recipe for recipe in get_random_local_recipes(num_recipes)
+                    if recipe.get('id') not in shown_ids][:num_recipes - len(recipes)]
+    return recipes or None
@@ -0,0 +1,119 @@
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Sequence
+from .db_api_responses import obtain_response_from_database, obtain_response_created_at
+from .payload_format import is_complete_recipe
+
+# number of stored responses whose parsed recipes are kept in memory (per process)
+PARSED_RESPONSES_LIMIT = 256
+
+
+class RecipeSummary:
+    """Recipe as shown on a card: id, title and photo."""
+    __slots__ = ('id', 'title', 'image')
+
+    def __init__(self, id: int | None, title: str, image: str | None):
+        self.id = id
+        self.title = title
+        self.image = image
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'RecipeSummary':
+        """Builds the summary from a recipe of any spoonacular endpoint."""
+        return cls(payload.get('id'), payload['title'], payload.get('image'))
+
+
+class RecipeDetail(RecipeSummary):
+    """
+    Recipe as shown on the details page: summary, instruction steps and ingredient lines.
+    Recipes built from lean search results are not complete - their details are fetched on demand.
+    """
+    __slots__ = ('instructions', 'ingredients', 'complete')
+
+    def __init__(self, id: int | None, title: str, image: str | None, instructions: list[dict],
+                 ingredients: list[str], complete: bool = True):
+        super().__init__(id, title, image)
+        self.instructions = instructions
+        self.ingredients = ingredients
+        self.complete = complete
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'RecipeDetail':
+        """
+        Builds the details from a recipe of any spoonacular endpoint.
+        Recipes from the "random" endpoint list all ingredients (extendedIngredients),
+        search results only name the ingredients used in the instruction steps.
+        """
+        instructions = []
+        if payload.get('analyzedInstructions'):
+            instructions = list(payload['analyzedInstructions'][0]['steps'])
+
+        if 'extendedIngredients' in payload:
+            ingredients = [ingredient['original'] for ingredient in payload['extendedIngredients']]
+        else:
+            ingredients = [ingredient['name'] for step in instructions for ingredient in step['ingredients']]
+        return cls(payload.get('id'), payload['title'], payload.get('image'), instructions, ingredients,
+                   is_complete_recipe(payload))
+
+    def fingerprint(self) -> str:
+        """
+        :return: checksum of the rendered content - recipes with the same id differ between endpoints,
+            e.g. search results list fewer ingredients than random recipes
+        """
+        text = '\x1f'.join([self.title, self.image or '', '\n'.join(self.ingredients),
+                            '\n'.join(step.get('step', '') for step in self.instructions)])
+        return f'{self.id}-{zlib.crc32(text.encode("utf-8")):08x}'
+
+
+class RecipeList(Sequence):
+    """Recipes of a stored response, each parsed into a RecipeDetail once, on first access."""
+
+    def __init__(self, payloads: Sequence, created_at: float | None = None):
+        self.payloads = payloads
+        self.created_at = created_at
+        self.recipes = [None] * len(payloads)
+
+    def __len__(self) -> int:
+        return len(self.payloads)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self.recipes[index] is None:
+            self.recipes[index] = RecipeDetail.from_payload(self.payloads[index])
+        return self.recipes[index]
+
+    def replace(self, index: int, recipe: RecipeDetail) -> None:
+        """Replaces a parsed recipe, e.g. a lean one with its complete details, for later readers of the list."""
+        self.recipes[index] = recipe
+
+
+parsed_responses = OrderedDict()
+parsed_responses_lock = threading.Lock()
+
+
+def load_recipes(unique_name: str) -> RecipeList | None:
+    """
+    Retrieves the recipes of a stored response. Parsed recipes are reused until the response is overwritten.
+    :return: RecipeList or None if no response is stored under this name
+    """
+    created_at = obtain_response_created_at(unique_name)
+    if created_at is None:
+        return None
+    with parsed_responses_lock:
+        cached = parsed_responses.get(unique_name)
+        if cached is not None and cached[0] == created_at:
+            parsed_responses.move_to_end(unique_name)
+            return cached[1]
+
+    payloads = obtain_response_from_database(unique_name)
+    if payloads is None:
+        return None
+    recipes = RecipeList(payloads, created_at)
+    with parsed_responses_lock:
+        parsed_responses[unique_name] = (created_at, recipes)
+        parsed_responses.move_to_end(unique_name)
+        while len(parsed_responses) > PARSED_RESPONSES_LIMIT:
+            parsed_responses.popitem(last=False)
+    return recipes
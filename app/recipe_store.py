@@ -0,0 +1,246 @@
+import sqlite3
+import re
+import time
+from .db_api_responses import get_connection
+from .payload_format import encode_recipe, decode_recipe, is_complete_recipe
+
+# BM25 weights of the full-text index columns: title, ingredients, cuisines, diets, instructions
+BM25_WEIGHTS = (10.0, 3.0, 2.0, 2.0, 1.0)
+
+# boolean fields of spoonacular recipes and the diets they stand for
+DIET_FLAGS = {'vegan': 'vegan', 'vegetarian': 'vegetarian', 'glutenFree': 'gluten free', 'dairyFree': 'dairy free'}
+
+
+def init_recipe_store() -> None:
+    """Creates the tables of the local recipe store and its full-text index."""
+    try:
+        connection = get_connection()
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS local_recipes (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            image TEXT,
+            instructions TEXT NOT NULL,
+            popularity INTEGER NOT NULL DEFAULT 0,
+            json TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS local_recipe_ingredients (
+            recipe_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (recipe_id, name)
+            );
+            CREATE TABLE IF NOT EXISTS local_recipe_cuisines (
+            recipe_id INTEGER NOT NULL,
+            cuisine TEXT NOT NULL,
+            PRIMARY KEY (recipe_id, cuisine)
+            );
+            CREATE TABLE IF NOT EXISTS local_recipe_diets (
+            recipe_id INTEGER NOT NULL,
+            diet TEXT NOT NULL,
+            PRIMARY KEY (recipe_id, diet)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS local_recipes_fts USING fts5(
+            title, ingredients, cuisines, diets, instructions,
+            tokenize = 'porter unicode61'
+            );
+            ''')
+        # stores created before recipes were versioned
+        with connection:
+            columns = [row[1] for row in connection.execute('''PRAGMA table_info(local_recipes)''')]
+            if 'version' not in columns:
+                connection.execute('''ALTER TABLE local_recipes ADD COLUMN version INTEGER NOT NULL DEFAULT 0''')
+            connection.execute('''CREATE INDEX IF NOT EXISTS local_recipes_version ON local_recipes (version)''')
+    except sqlite3.Error as e:
+        print(f"Recipe store initialization error: {e}")
+
+
+def extract_recipe_fields(recipe: dict) -> tuple[list[str], list[str], list[str], list[str]]:
+    """
+    Extracts searchable fields from a recipe of any spoonacular endpoint.
+    :return: instruction steps, ingredient names, cuisines, diets
+    """
+    steps = []
+    step_ingredients = []
+    if recipe.get('analyzedInstructions'):
+        for step in recipe['analyzedInstructions'][0].get('steps', []):
+            steps.append(step.get('step', ''))
+            for ingredient in step.get('ingredients', []):
+                step_ingredients.append(ingredient['name'])
+
+    # recipes from the "random" endpoint list all ingredients, search results only those used in the steps
+    if recipe.get('extendedIngredients'):
+        ingredients = [ingredient['name'] for ingredient in recipe['extendedIngredients'] if ingredient.get('name')]
+    else:
+        ingredients = step_ingredients
+
+    cuisines = [cuisine.lower() for cuisine in recipe.get('cuisines', [])]
+    diets = [diet.lower() for diet in recipe.get('diets', [])]
+    # boolean flags of the recipe are stored as diets as well
+    for flag, diet in DIET_FLAGS.items():
+        if recipe.get(flag):
+            diets.append(diet)
+    return steps, sorted(set(ingredients)), sorted(set(cuisines)), sorted(set(diets))
+
+
+def ingest_recipes(recipes: list[dict]) -> None:
+    """
+    Stores recipes received from the API in the local recipe store, replacing older versions of them.
+    Lean search results never replace stored recipes, which may be complete.
+    Every ingest gets a new version number, so readers can pick up changed recipes incrementally.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        # take the write lock before reading the last version, so concurrent ingests get distinct versions
+        cursor.execute('''BEGIN IMMEDIATE''')
+        version = cursor.execute('''SELECT COALESCE(MAX(version), 0) + 1 FROM local_recipes''').fetchone()[0]
+        now = time.time()
+        for recipe in recipes:
+            if 'id' not in recipe or 'title' not in recipe:
+                continue
+            recipe_id = recipe['id']
+            if not is_complete_recipe(recipe) and cursor.execute('''SELECT 1 FROM local_recipes WHERE id = ?''',
+                                                                 (recipe_id,)).fetchone() is not None:
+                continue
+            steps, ingredients, cuisines, diets = extract_recipe_fields(recipe)
+
+            cursor.execute('''DELETE FROM local_recipe_ingredients WHERE recipe_id = ?''', (recipe_id,))
+            cursor.execute('''DELETE FROM local_recipe_cuisines WHERE recipe_id = ?''', (recipe_id,))
+            cursor.execute('''DELETE FROM local_recipe_diets WHERE recipe_id = ?''', (recipe_id,))
+            cursor.execute('''DELETE FROM local_recipes_fts WHERE rowid = ?''', (recipe_id,))
+            cursor.execute('''INSERT OR REPLACE INTO local_recipes
+                              (id, title, image, instructions, popularity, json, updated_at, version)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (recipe_id, recipe['title'], recipe.get('image'), '\n'.join(steps),
+                            recipe.get('aggregateLikes', 0), encode_recipe(recipe), now, version))
+            cursor.executemany('''INSERT INTO local_recipe_ingredients (recipe_id, name) VALUES (?, ?)''',
+                               [(recipe_id, name) for name in ingredients])
+            cursor.executemany('''INSERT INTO local_recipe_cuisines (recipe_id, cuisine) VALUES (?, ?)''',
+                               [(recipe_id, cuisine) for cuisine in cuisines])
+            cursor.executemany('''INSERT INTO local_recipe_diets (recipe_id, diet) VALUES (?, ?)''',
+                               [(recipe_id, diet) for diet in diets])
+            cursor.execute('''INSERT INTO local_recipes_fts (rowid, title, ingredients, cuisines, diets, instructions)
+                              VALUES (?, ?, ?, ?, ?, ?)''',
+                           (recipe_id, recipe['title'], ' '.join(ingredients), ' '.join(cuisines),
+                            ' '.join(diets), ' '.join(steps)))
+        connection.commit()
+    except sqlite3.Error as e:
+        connection.rollback()
+        print(f"Recipe store error while ingesting recipes: {e}")
+    except BaseException:
+        # the connection outlives the call - never leave the write lock or half an ingest on it
+        connection.rollback()
+        raise
+
+
+def build_match_expression(query: str) -> str | None:
+    """
+    Turns a user's query into an FTS5 expression: every word must appear, as a prefix,
+    in the title or in the ingredients of the recipe.
+    :return: FTS5 MATCH expression or None if the query has no words
+    """
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    terms = ' '.join(f'"{word}"*' for word in words)
+    return f'{{title ingredients}} : ({terms})'
+
+
+def search_local_recipes(query: str, limit: int = 12, offset: int = 0) -> list[dict]:
+    """
+    Searches the local recipe store, ranking matches with BM25 (title matches weigh the most).
+    :return: list of recipes, best matches first, skipping the first offset matches
+    """
+    match_expression = build_match_expression(query or '')
+    if match_expression is None:
+        return []
+    try:
+        connection = get_connection()
+        cursor = connection.execute(f'''SELECT local_recipes.json FROM local_recipes_fts
+                                     JOIN local_recipes ON local_recipes.id = local_recipes_fts.rowid
+                                     WHERE local_recipes_fts MATCH ?
+                                     ORDER BY bm25(local_recipes_fts, {", ".join(map(str, BM25_WEIGHTS))})
+                                     LIMIT ? OFFSET ?''', (match_expression, limit, offset))
+        return [decode_recipe(row[0]) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Recipe store error while searching: {e}")
+        return []
+
+
+def get_local_recipes(recipe_ids: list[int]) -> list[dict]:
+    """
+    Retrieves recipes from the local recipe store.
+    :return: list of recipes in the order of recipe_ids, missing recipes are skipped
+    """
+    if not recipe_ids:
+        return []
+    try:
+        connection = get_connection()
+        placeholders = ', '.join('?' * len(recipe_ids))
+        rows = connection.execute(f'''SELECT id, json FROM local_recipes WHERE id IN ({placeholders})''',
+                                  recipe_ids).fetchall()
+        recipes = {row[0]: decode_recipe(row[1]) for row in rows}
+        return [recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in recipes]
+    except sqlite3.Error as e:
+        print(f"Recipe store error while retrieving recipes: {e}")
+        return []
+
+
+def get_random_local_recipes(limit: int) -> list[dict]:
+    """:return: up to limit recipes picked at random from the local recipe store"""
+    try:
+        connection = get_connection()
+        rows = connection.execute('''SELECT json FROM local_recipes WHERE id IN
+                                     (SELECT id FROM local_recipes ORDER BY random() LIMIT ?)''', (limit,)).fetchall()
+        return [decode_recipe(row[0]) for row in rows]
+    except sqlite3.Error as e:
+        print(f"Recipe store error while picking random recipes: {e}")
+        return []
+
+
+def get_complete_recipe(recipe_id: int) -> dict | None:
+    """:return: recipe from the local recipe store, None if it is missing or only a lean search result"""
+    recipes = get_local_recipes([recipe_id])
+    if recipes and is_complete_recipe(recipes[0]):
+        return recipes[0]
+    return None
+
+
+def get_changed_recipes(after_version: int) -> list[tuple[int, int, int, str, str]]:
+    """
+    Retrieves filterable fields of the recipes ingested after the given version.
+    :return: list of (id, version, popularity, cuisines, diets) ordered by version,
+        cuisines and diets joined with '|'
+    """
+    try:
+        connection = get_connection()
+        return connection.execute('''SELECT id, version, popularity,
+                                      (SELECT group_concat(cuisine, '|') FROM local_recipe_cuisines
+                                       WHERE recipe_id = local_recipes.id),
+                                      (SELECT group_concat(diet, '|') FROM local_recipe_diets
+                                       WHERE recipe_id = local_recipes.id)
+                                      FROM local_recipes WHERE version > ? ORDER BY version''',
+                                  (after_version,)).fetchall()
+    except sqlite3.Error as e:
+        print(f"Recipe store error while retrieving changed recipes: {e}")
+        return []
+
+
+def find_local_recipe_ids_by_title(titles: list[str]) -> dict[str, int]:
+    """
+    Looks up spoonacular ids of recipes by title. Titles shared by several local recipes are skipped.
+    :return: title -> spoonacular id
+    """
+    if not titles:
+        return {}
+    try:
+        connection = get_connection()
+        placeholders = ', '.join('?' * len(titles))
+        rows = connection.execute(f'''SELECT title, MIN(id) FROM local_recipes WHERE title IN ({placeholders})
+                                      GROUP BY title HAVING COUNT(*) = 1''', list(titles)).fetchall()
+        return {row[0]: row[1] for row in rows}
+    except sqlite3.Error as e:
+        print(f"Recipe store error while looking up titles: {e}")
+        return {}
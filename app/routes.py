@@ -1,15 +1,29 @@
-from flask import render_template, request, redirect, url_for, Blueprint, flash
-from .db_api_responses import obtain_response_from_database, pass_response_to_database
+from flask import (render_template, request, redirect, url_for, Blueprint, flash, jsonify, abort, session,
+                   current_app, make_response, send_file)
+from .db_api_responses import pass_response_to_database, cache_stats
+from .recipe_model import RecipeSummary, load_recipes
 from .auth_db import register_check_if_user_exists, login_check_if_user_exists
-from .api import search_recipe, get_random_recipes
+from .random_pool import take_random_recipes
+from .search import find_recipes, complete_recipe, has_next_page, find_next_page, prefetch_next_page
+from .budget import budget_status, remaining_points
+from .image_proxy import IMAGE_VARIANTS, is_allowed_image_url, cached_image
+from .fragment_cache import render_fragment, fragment_key, template_version, page_etag, fragment_stats
+from .metrics import render_metrics
+from .password_hashing import hashing_stats, stats_lock
+import hmac
 import json
+import os
+import time
+from typing import Callable
 from .forms import RegisterForm, LoginForm
 from flask_login import current_user, logout_user, login_required
 from . import login_manager
-from .models import (User, Recipe, sqlalchemy_db, is_recipe_saved_by_user, save_recipe_for_current_user,
-                     unsave_recipe_for_current_user)
+from .models import (Recipe, sqlalchemy_db, is_recipe_saved_by_user, save_recipe_for_current_user,
+                     unsave_recipe_for_current_user, saved_recipe_cards, load_cached_user,
+                     user_loader_counters)
+from .config import Config
 from werkzeug.wrappers import Response
-from typing import Tuple
+from werkzeug.exceptions import InternalServerError
 
 with open('data.json', 'r') as file:
     json_data = json.load(file)
@@ -25,62 +39,69 @@ def internal_error(error):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return load_cached_user(user_id)
 
 
-def return_recipe_details(response: list, i: int, unique_name: str) \
-        -> Tuple[str, str, list, list]:
+def render_conditionally(etag_parts: list, render: Callable[[], str]) -> Response:
     """
-    Extracts recipe details from the API response.
-    :return: dish_name, dish_photo, instructions, ingredients
+    Renders a page with an ETag, or answers 304 Not Modified when the browser already holds the same page.
+    Pages embed the user's CSRF token, so the ETag also covers the token and the half of WTF_CSRF_TIME_LIMIT
+    the page was rendered in - a reused page always has at least half of the limit left to submit its forms.
+    :param etag_parts: everything else the page depends on, e.g. template versions, fragment keys, saved flag
+    :param render: renders the page
     """
-    dish_name = response[i]['title']
-    # check if image available for this recipe
-    if 'image' in response[i].keys():
-        dish_photo = response[i]['image']
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time.time() // (time_limit / 2)) if time_limit else 0
+
+    def etag() -> str:
+        return page_etag(current_user.get_id(), session.get('csrf_token'), period, *etag_parts)
+
+    if '_flashes' in session:
+        # a page showing a one-time message is neither answered from nor kept for the browser's cache
+        response = make_response(render())
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    if request.method == 'GET' and etag() in request.if_none_match:
+        response = Response(status=304)
     else:
-        dish_photo = None
-
-    instructions = []
-    if len(response[i]['analyzedInstructions']) > 0:
-        for instruction in response[i]['analyzedInstructions'][0]['steps']:
-            instructions.append(instruction)
-
-    # different responses for different spoonacular searching endpoints
-    if unique_name in ['2', '4']:
-        ingredients = []
-        for ingredient in response[i]['extendedIngredients']:
-            ingredients.append(ingredient['original'])
-        return dish_name, dish_photo, instructions, ingredients
-    else:
-        ingredients = []
-        if len(response[i]['analyzedInstructions']) > 0:
-            for step in response[i]['analyzedInstructions'][0]['steps']:
-                for ingredient in step['ingredients']:
-                    ingredients.append(ingredient['name'])
-        return dish_name, dish_photo, instructions, ingredients
+        response = make_response(render())
+    # computed after rendering, which creates the CSRF token on the first visit
+    response.set_etag(etag())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 def fetch_dish_details_and_render_site(unique_name: str, i: int = 0):
     """
     Fetches dish details from the database and renders the details page.
+    The recipe body is rendered once per recipe content, the heart form on every request.
     Returns:
-        i: number of recipe in response.json()['recipes']
+        i: number of recipe in the stored response
     """
-    response = obtain_response_from_database(unique_name)
+    recipes = load_recipes(unique_name)
 
-    if response is not None:
-        dish_name = response[i]['title']
-        recipe_id = Recipe.get_id_by_name(dish_name)
+    if recipes is not None and 0 <= i < len(recipes):
+        # search results are lean, their details are fetched when the page is first opened
+        recipe = complete_recipe(recipes, i)
+        recipe_id = Recipe.get_id_for_recipe(recipe)
         if recipe_id is not None:  # recipe saved in database
             recipe_saved_by_user = is_recipe_saved_by_user(recipe_id)
         else:
             recipe_saved_by_user = False
 
-        dish_name, dish_photo, instructions, ingredients = return_recipe_details(response, i, unique_name)
-        return render_template('dishDetails.html', dish_name=dish_name, dish_photo=dish_photo,
-                               instructions=instructions, ingredients=ingredients,
-                               unique_name=unique_name, id_num=i, recipe_saved_by_user=recipe_saved_by_user)
+        identity = recipe.fingerprint()
+        etag_parts = [template_version('dishDetails.html'), fragment_key('fragments/recipeBody.html', identity),
+                      recipe.title, unique_name, i, recipe_id, recipe_saved_by_user]
+
+        def render() -> str:
+            recipe_body = render_fragment('fragments/recipeBody.html', identity,
+                                          lambda: {'title': recipe.title, 'image': recipe.image,
+                                                   'ingredients': recipe.ingredients,
+                                                   'instructions': recipe.instructions})
+            return render_template('dishDetails.html', recipe=recipe, recipe_id=recipe_id, recipe_body=recipe_body,
+                                   unique_name=unique_name, id_num=i, recipe_saved_by_user=recipe_saved_by_user)
+
+        return render_conditionally(etag_parts, render)
     else:
         return redirect(url_for('main.error'))
 
@@ -89,11 +110,8 @@ def capture_searched_data() -> Response:
     """Captures data from the "search" field in the navbar and manage it."""
     searched_dish_name = request.form.get('search')
 
-    response = search_recipe(dish_name=searched_dish_name)
-    if response != 1:
-        unique_name = '1'
-        new_json_data = response.json()['results']
-        pass_response_to_database(unique_name, new_json_data)
+    unique_name = find_recipes(dish_name=searched_dish_name)
+    if unique_name is not None:
         # redirect to a page with a list of recipes matching the searched term
         return redirect(url_for('main.searching_results', unique_name=unique_name))
     else:
@@ -108,15 +126,16 @@ def start():
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
     elif request.method == 'GET':
-        response = get_random_recipes(num_recipes=12)
+        recipes = take_random_recipes(num_recipes=12)
+        if recipes is None:
+            raise InternalServerError("No random recipes available.")
 
         unique_name = '2'
-        new_json_data = response.json()['recipes']
-        pass_response_to_database(unique_name, new_json_data)
+        pass_response_to_database(unique_name, recipes, wait=False)
 
         return render_template('start.html',
-                               response_results=response.json()['recipes'],
-                               unique_name=unique_name)
+                               response_results=[RecipeSummary.from_payload(recipe) for recipe in recipes],
+                               num_cards=len(recipes), unique_name=unique_name)
 
 
 @main_bp.route('/chooseFilter', methods=['GET', 'POST'])
@@ -141,18 +160,13 @@ def preferences():
 
         # search for recipes, take filters into account
         if type_value == '1':
-            response = search_recipe(user_intolerances=preferences_checked)
+            unique_name = find_recipes(user_intolerances=preferences_checked)
         elif type_value == '2':
-            response = search_recipe(cuisine_type=preferences_checked)
+            unique_name = find_recipes(cuisine_type=preferences_checked)
         else:
-            response = search_recipe(diet_type=preferences_checked)
-
-        if response != '1':
-            # Store response in database, using a unique key
-            unique_name = '3'
-            new_json_data = response.json()['results']
-            pass_response_to_database(unique_name, new_json_data)
+            unique_name = find_recipes(diet_type=preferences_checked)
 
+        if unique_name is not None:
             return redirect(url_for('main.searching_results', unique_name=unique_name))
         else:
             return redirect(url_for('main.error'))
@@ -181,12 +195,12 @@ def details(id_num: int, unique_name: str):
 def random():
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
-    response = get_random_recipes(num_recipes=1)
-    if response != 1:
+    recipes = take_random_recipes(num_recipes=1)
+    if recipes is not None:
         unique_name = '4'
-        new_json_data = response.json()['recipes']
-        pass_response_to_database(unique_name, new_json_data)
+        pass_response_to_database(unique_name, recipes, wait=False)
         return fetch_dish_details_and_render_site(unique_name=unique_name, i=0)
+    return redirect(url_for('main.error'))
 
 
 @main_bp.route('/searchingResults', methods=['GET', 'POST'])
@@ -195,16 +209,29 @@ def searching_results():
         return capture_searched_data()
 
     unique_name = request.args.get('unique_name')
-    response_results = obtain_response_from_database(unique_name)
+    response_results = load_recipes(unique_name)
 
     if response_results is not None:
-        num_cards = 12
-        if len(response_results) < 12:
-            num_cards = len(response_results)
-        return render_template('searchingResults.html',
-                               response_results=response_results, unique_name=unique_name, num_cards=num_cards)
+        num_cards = min(len(response_results), Config.SEARCH_PAGE_SIZE)
+        # the next page is fetched while this one renders and the user reads it
+        prefetch_next_page(unique_name, len(response_results))
+        # cards of a stored response are rendered once per version of the response
+        recipe_cards = render_fragment('fragments/recipeCards.html', f'{unique_name}-{response_results.created_at}',
+                                       lambda: {'response_results': response_results, 'unique_name': unique_name,
+                                                'num_cards': num_cards})
+        return render_template('searchingResults.html', recipe_cards=recipe_cards, unique_name=unique_name,
+                               next_page=has_next_page(unique_name, len(response_results)))
     else:
-        redirect(url_for('main.error'))
+        return redirect(url_for('main.error'))
+
+
+@main_bp.route('/searchingResults/next', methods=['GET'])
+def next_results():
+    """Redirects to the page of search results following the given one."""
+    next_name = find_next_page(request.args.get('unique_name', ''))
+    if next_name is None:
+        return redirect(url_for('main.error'))
+    return redirect(url_for('main.searching_results', unique_name=next_name))
 
 
 @main_bp.route('/error', methods=['GET', 'POST'])
@@ -216,6 +243,82 @@ def error():
     return render_template('error.html', searched_phrase=searched_phrase)
 
 
+@main_bp.route('/image/<variant>', methods=['GET'])
+def image(variant):
+    """
+    Serves a resized dish photo from the local cache. Cached files never change, so browsers keep them for a year.
+    Falls back to the original photo when it can't be downloaded.
+    """
+    src = request.args.get('src', '')
+    if variant not in IMAGE_VARIANTS or not is_allowed_image_url(src):
+        abort(404)
+    cached = cached_image(variant, src)
+    if cached is None:
+        return redirect(src)
+    path, mimetype = cached
+    response = send_file(os.path.abspath(path), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@main_bp.route('/apiBudget', methods=['GET'])
+def api_budget():
+    """
+    Reports today's spoonacular quota: points left, budget mode and points spent per endpoint.
+    Requires METRICS_TOKEN like /metrics - the quota tells how much traffic would exhaust it.
+    """
+    require_metrics_token()
+    return jsonify(budget_status())
+
+
+def require_metrics_token() -> None:
+    """
+    Lets only requests carrying METRICS_TOKEN as a bearer token through to operational endpoints.
+    Without a configured token, the endpoints don't exist.
+    """
+    if not Config.METRICS_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {Config.METRICS_TOKEN}'):
+        abort(401)
+
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Exposes this worker's latency histograms and cache and hashing counters in the Prometheus text format.
+    The scraper must send METRICS_TOKEN as a bearer token.
+    """
+    if not Config.METRICS_ENABLED:
+        abort(404)
+    require_metrics_token()
+    responses, fragments = cache_stats(), fragment_stats()
+    with stats_lock:
+        hashing = {operation: dict(stats) for operation, stats in hashing_stats.items()}
+    samples = [
+        ('response_cache_requests_total', 'counter', 'Lookups of stored API responses.',
+         {(('result', 'hit'),): responses['hits'], (('result', 'miss'),): responses['misses']}),
+        ('response_cache_evictions_total', 'counter', 'Stored API responses evicted.', {(): responses['evictions']}),
+        ('response_cache_entries', 'gauge', 'Stored API responses.', {(): responses['entries'] or 0}),
+        ('fragment_cache_requests_total', 'counter', 'Lookups of rendered fragments.',
+         {(('result', 'hit'),): fragments['local_hits'], (('result', 'shared_hit'),): fragments['shared_hits'],
+          (('result', 'miss'),): fragments['misses']}),
+        ('fragment_cache_entries', 'gauge', 'Rendered fragments in memory.', {(): fragments['entries']}),
+        ('user_loader_requests_total', 'counter', 'Users loaded for Flask-Login.',
+         {(('source', 'cache'),): user_loader_counters['cache_hits'],
+          (('source', 'database'),): user_loader_counters['db_hits']}),
+        ('password_hashing_total', 'counter', 'Password hashes computed in the pool.',
+         {(('operation', operation),): stats['count'] for operation, stats in hashing.items()}),
+        ('password_hashing_rejected_total', 'counter', 'Password hashes rejected while the pool was busy.',
+         {(('operation', operation),): stats['rejected'] for operation, stats in hashing.items()}),
+        ('password_hashing_compute_seconds_total', 'counter', 'Time spent computing password hashes.',
+         {(('operation', operation),): stats['compute_seconds'] for operation, stats in hashing.items()}),
+        ('password_hashing_wait_seconds_total', 'counter', 'Time password hashes waited for the pool.',
+         {(('operation', operation),): stats['wait_seconds'] for operation, stats in hashing.items()}),
+        ('spoonacular_quota_remaining_points', 'gauge', 'Quota points left today.', {(): remaining_points()}),
+    ]
+    return Response(render_metrics(samples), mimetype='text/plain; version=0.0.4')
+
+
 # auth_bp -------------------------------------------------------------------------------------------------------------
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
@@ -236,6 +339,9 @@ def register():
         elif user_exists == 2:
             flash("Registration failed, please try again.")
             return redirect(url_for("auth.register"))
+        elif user_exists == 3:
+            flash("Too many people are signing up right now, please try again in a moment.")
+            return redirect(url_for("auth.register"))
     return render_template('register.html', form=register_form, current_user=current_user)
 
 
@@ -257,6 +363,9 @@ def login():
         elif if_user_logged == 2:
             flash('Password incorrect, please try again.')
             return redirect(url_for('auth.login'))
+        elif if_user_logged == 3:
+            flash('Too many logins right now, please try again in a moment.')
+            return redirect(url_for('auth.login'))
         else:
             return redirect(url_for('main.start'))
     return render_template("login.html", form=login_form, current_user=current_user)
@@ -270,77 +379,54 @@ def logout():
 
 
 @main_bp.route('/saveRecipe/<unique_name>/<int:recipe_number>', methods=['POST'])
-@main_bp.route('/saveRecipe/<dish_name>', methods=['POST'])
+@main_bp.route('/saveRecipe/<int:recipe_id>', methods=['POST'])
 @login_required
-def save_recipe(unique_name=None, recipe_number=None, dish_name=None):
+def save_recipe(unique_name=None, recipe_number=None, recipe_id=None):
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
 
-    # if recipe_number is None --> recipe is already saved in database (Recipe) -- redirected from savedDishDetails.html
-    if recipe_number is None and unique_name is None and dish_name:
-        # Retrieve dish details straight from database - Recipe
-        recipe_id = Recipe.get_id_by_name(dish_name)
-        recipe = Recipe.query.get_or_404(recipe_id)
-        # Save recipe in current_user saved_recipes
-        # Check if the recipe is already saved
-        if recipe not in current_user.saved:
-            # Save recipe in current user's saved
-            save_recipe_for_current_user(recipe)
-        # Redirect back to the recipe page
-        return redirect(request.referrer)
-    # recipe can be or not saved in database (Recipe)
-    elif (unique_name and recipe_number) or unique_name:  # recipe number can be a zero (0)
+    # if recipe_id is given --> recipe is already saved in database (Recipe)
+    if recipe_id is None and unique_name is not None:
         # Retrieve the data from the database using unique name
-        response_results = obtain_response_from_database(unique_name)
-
-        if response_results is not None:
-            dish_name, dish_photo, instructions, ingredients = (
-                return_recipe_details(response=response_results, i=recipe_number, unique_name=unique_name))
-            # look for this dish in the database (Recipe)
-            recipe_id = Recipe.get_id_by_name(dish_name)
-            if recipe_id is None:
-                # no dish with this name found in the database -- add recipe with this recipe_name to database
-                new_recipe = Recipe.add_new_recipe(dish_name=dish_name, dish_photo=dish_photo,
-                                                   instructions=json.dumps(instructions),
-                                                   ingredients=json.dumps(ingredients))
-                recipe_id = new_recipe.id
-            # Retrieve the recipe by ID
-            recipe = Recipe.query.get_or_404(recipe_id)
-
-            # Check if the recipe is already saved in current user's saved -- if not - save it there
-            if recipe not in current_user.saved:
-                # Save recipe in current user's saved
-                save_recipe_for_current_user(recipe)
-            # Redirect back to the recipe page
-            return redirect(request.referrer)
-        else:
+        response_results = load_recipes(unique_name)
+        if response_results is None or recipe_number >= len(response_results):
             return redirect(request.referrer)
-    else:
-        return redirect(request.referrer)
 
-
-@main_bp.route('/unsaveRecipe/<dish_name>', methods=['POST'])
+        recipe_detail = response_results[recipe_number]
+        # look for this dish in the database (Recipe)
+        recipe_id = Recipe.get_id_for_recipe(recipe_detail)
+        if recipe_id is None:
+            # dish not found in the database -- add it, with the details lean search results lack
+            recipe_detail = complete_recipe(response_results, recipe_number)
+            if not recipe_detail.complete:
+                # saved recipes are never refreshed, so they are only saved with instructions and ingredients
+                flash("This recipe can't be saved right now, please try again later.")
+                return redirect(request.referrer)
+            recipe_id = Recipe.add_new_recipe(recipe_detail)
+    elif sqlalchemy_db.session.get(Recipe, recipe_id) is None:
+        abort(404)
+
+    # Save recipe in current user's saved (nothing happens if it's already saved)
+    save_recipe_for_current_user(recipe_id)
+    # Redirect back to the recipe page
+    return redirect(request.referrer)
+
+
+@main_bp.route('/unsaveRecipe/<int:recipe_id>', methods=['POST'])
 @login_required
-def unsave_recipe(dish_name):
+def unsave_recipe(recipe_id):
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
 
-    # recipe was saved by someone, so it is in database for sure
-    if dish_name:
-        recipe_id = Recipe.get_id_by_name(dish_name)
-        # Find the recipe with recipe_id
-        recipe = Recipe.query.get(recipe_id)
-
-        # Check if the recipe exists and is in the current user's saved recipes
-        if recipe in current_user.saved:
-            try:
-                # Remove the recipe from the user's saved recipes
-                unsave_recipe_for_current_user(recipe)
-            except Exception:
-                # Rollback in case of any error
-                sqlalchemy_db.session.rollback()
-        # Redirect back
-        return redirect(request.referrer)
+    # removing a recipe that isn't saved changes nothing
+    try:
+        # Remove the recipe from the user's saved recipes
+        unsave_recipe_for_current_user(recipe_id)
+    except Exception:
+        # Rollback in case of any error
+        sqlalchemy_db.session.rollback()
+    # Redirect back
+    return redirect(request.referrer)
 
 
 @main_bp.route('/savedDishDetails/<int:recipe_id>', methods=['GET', 'POST'])
@@ -349,24 +435,26 @@ def saved_dish_details(recipe_id):
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
 
-    # Query to check if the recipe is in the current user's saved recipes
-    saved_recipe = current_user.saved.filter_by(id=recipe_id).first()
-
-    # Check if the recipe exists in the saved list
-    if saved_recipe:
-        dish_name = saved_recipe.dish_name
-        dish_photo = saved_recipe.dish_photo
-        ingredients = []
-        for ingredient in json.loads(saved_recipe.ingredients):
-            ingredients.append(ingredient)
-        instructions = []
-        for instruction in json.loads(saved_recipe.instructions):
-            instructions.append(instruction)
-        return render_template('savedDishDetails.html', dish_name=dish_name, dish_photo=dish_photo,
-                               instructions=instructions, ingredients=ingredients)
-    else:
+    # Check if the recipe is in the current user's saved recipes
+    if not is_recipe_saved_by_user(recipe_id):
         return redirect(url_for('main.saved_recipes'))
 
+    # saved recipes never change, so the page only depends on the templates and the user
+    identity = f'saved-{recipe_id}'
+    etag_parts = [template_version('savedDishDetails.html'), fragment_key('fragments/recipeBody.html', identity),
+                  recipe_id]
+
+    def render() -> str:
+        saved_recipe = sqlalchemy_db.session.get(Recipe, recipe_id)
+        recipe_body = render_fragment('fragments/recipeBody.html', identity,
+                                      lambda: {'title': saved_recipe.dish_name, 'image': saved_recipe.dish_photo,
+                                               'ingredients': json.loads(saved_recipe.ingredients),
+                                               'instructions': json.loads(saved_recipe.instructions)})
+        return render_template('savedDishDetails.html', recipe_id=recipe_id, dish_name=saved_recipe.dish_name,
+                               recipe_body=recipe_body)
+
+    return render_conditionally(etag_parts, render)
+
 
 @main_bp.route('/savedRecipes', methods=['GET', 'POST'])
 @login_required
@@ -375,5 +463,6 @@ def saved_recipes():
     if request.method == 'POST' and 'search' in request.form:
         return capture_searched_data()
 
-    users_saved_recipes = current_user.saved.all()
-    return render_template('savedRecipes.html', recipes=users_saved_recipes)
+    after_recipe_id = request.args.get('after', type=int)
+    recipe_cards, next_after = saved_recipe_cards(after_recipe_id, Config.SAVED_RECIPES_PAGE_SIZE)
+    return render_template('savedRecipes.html', recipes=recipe_cards, next_after=next_after)
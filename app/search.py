@@ -0,0 +1,181 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import InternalServerError
+from .config import Config
+from .api import search_recipe, get_recipe_information
+from .db_api_responses import make_cache_key, obtain_cached_response, pass_response_to_database, obtain_search_page
+from .recipe_store import ingest_recipes, search_local_recipes, get_local_recipes, get_complete_recipe
+from .recipe_model import RecipeDetail, RecipeList
+from .filter_index import filter_index
+from .singleflight import single_flight
+from .budget import budget_mode, NORMAL, SERVE_STALE, REJECT
+
+
+def find_recipes(dish_name: str = None, user_intolerances: list[str] = None, cuisine_type: list[str] = None,
+                 diet_type: list[str] = None, page: int = 0, source: str | None = None) -> str | None:
+    """
+    Finds one page of recipes matching the query. Sources are tried from the cheapest one:
+    cached response of an identical query, local recipe store (full-text search for a dish name,
+    filter index for intolerances, cuisines and diets), spoonacular API.
+    The less API budget is left, the more readily cheaper sources are used (see budget_mode).
+    Results are stored in the database under the canonical key of the query and the page,
+    together with the query itself, so that the following pages can be fetched (see find_next_page).
+    :param source: 'local' or 'api' - the source of the query's first page, which the following pages must
+        come from too, as the sources order results differently; None lets the first page pick one
+    :return: unique name of the stored response, None if no recipes were found
+    """
+    offset = page * Config.SEARCH_PAGE_SIZE
+    # the first page keeps the key it had before searches were paginated
+    cache_key = make_cache_key(query=dish_name, intolerances=user_intolerances, cuisine=cuisine_type,
+                               diet=diet_type, offset=offset or None, source=source if offset else None)
+    params = {'dish_name': dish_name, 'user_intolerances': user_intolerances, 'cuisine_type': cuisine_type,
+              'diet_type': diet_type}
+    mode = budget_mode()
+    if obtain_cached_response(cache_key, allow_stale=mode in [SERVE_STALE, REJECT]) is not None:
+        return cache_key
+
+    def store_page(results: list, total_results: int | None, page_source: str) -> str:
+        pass_response_to_database(cache_key, results,
+                                  search_page=(dict(params, source=page_source), offset, total_results))
+        return cache_key
+
+    # later pages of a query answered locally come from the local store only, whatever they hold
+    min_local_hits = 1 if mode != NORMAL or source == 'local' else Config.LOCAL_SEARCH_MIN_HITS
+    local_search = source != 'api'
+    if local_search and dish_name and not (user_intolerances or cuisine_type or diet_type):
+        # one more than a page tells whether another page follows
+        local_results = search_local_recipes(dish_name, limit=Config.SEARCH_PAGE_SIZE + 1, offset=offset)
+        if len(local_results) >= min_local_hits:
+            last_page = len(local_results) <= Config.SEARCH_PAGE_SIZE
+            return store_page(local_results[:Config.SEARCH_PAGE_SIZE],
+                              offset + len(local_results) if last_page else None, 'local')
+    elif local_search and not dish_name:
+        local_matches = filter_index.filter_recipes(user_intolerances=user_intolerances, cuisine_type=cuisine_type,
+                                                    diet_type=diet_type, limit=offset + Config.SEARCH_PAGE_SIZE)
+        if local_matches is not None and len(local_matches[0]) - offset >= min_local_hits:
+            return store_page(get_local_recipes(local_matches[0][offset:]), local_matches[1], 'local')
+    if source == 'local':
+        return None
+
+    def fetch_from_api() -> str | None:
+        response = search_recipe(dish_name=dish_name, user_intolerances=user_intolerances,
+                                 cuisine_type=cuisine_type, diet_type=diet_type, offset=offset)
+        if response == 1:
+            return None
+        payload = response.json()
+        ingest_recipes(payload['results'])
+        return store_page(payload['results'], payload.get('totalResults'), 'api')
+
+    def find_in_cache() -> str | None:
+        return cache_key if obtain_cached_response(cache_key, count=False) is not None else None
+
+    # concurrent identical queries share one API call
+    return single_flight(cache_key, compute=fetch_from_api, lookup=find_in_cache)
+
+
+def has_next_page(unique_name: str, num_results: int) -> bool:
+    """:return: True if the stored page of search results is followed by another one"""
+    search_page = obtain_search_page(unique_name)
+    if search_page is None or num_results < Config.SEARCH_PAGE_SIZE:
+        return False
+    params, offset, total_results = search_page
+    next_offset = offset + Config.SEARCH_PAGE_SIZE
+    if next_offset >= Config.SEARCH_MAX_PAGES * Config.SEARCH_PAGE_SIZE:
+        return False
+    return total_results is None or next_offset < total_results
+
+
+def find_next_page(unique_name: str) -> str | None:
+    """
+    Finds the page of search results following a stored one - instantly if it was prefetched.
+    :return: unique name of the next page, None if there is none
+    """
+    search_page = obtain_search_page(unique_name)
+    if search_page is None:
+        return None
+    params, offset, total_results = search_page
+    return find_recipes(**params, page=offset // Config.SEARCH_PAGE_SIZE + 1)
+
+
+# unique names of pages whose next page is being prefetched (per process)
+prefetching = set()
+prefetching_lock = threading.Lock()
+prefetch_executor = None
+prefetch_pid = None
+
+
+def prefetch_next_page(unique_name: str, num_results: int) -> None:
+    """
+    Fetches the page following a stored page of search results in the background, so that it's already
+    stored when the user asks for it. Prefetching only spends API quota while the budget is in normal mode.
+    """
+    global prefetch_executor, prefetch_pid
+    if not has_next_page(unique_name, num_results) or budget_mode() != NORMAL:
+        return
+    with prefetching_lock:
+        if unique_name in prefetching:
+            return
+        prefetching.add(unique_name)
+        # threads don't survive fork, every worker starts its own
+        if prefetch_executor is None or prefetch_pid != os.getpid():
+            prefetch_executor = ThreadPoolExecutor(max_workers=Config.SEARCH_PREFETCH_WORKERS,
+                                                   thread_name_prefix='search-prefetch')
+            prefetch_pid = os.getpid()
+        executor = prefetch_executor
+
+    def prefetch() -> None:
+        try:
+            find_next_page(unique_name)
+        except Exception as e:
+            print(f"Search prefetch error: {e}")
+        finally:
+            with prefetching_lock:
+                prefetching.discard(unique_name)
+
+    executor.submit(prefetch)
+
+
+def fetch_recipe_information(recipe_id: int) -> dict | None:
+    """
+    Finds the complete recipe: in the local recipe store, which caches recipes by id for all workers,
+    or through the information endpoint of the API, whose answer is stored there.
+    Once the API budget is used up, recipes missing locally stay lean.
+    :return: recipe or None if it doesn't exist or the budget doesn't allow fetching it
+    """
+    recipe = get_complete_recipe(recipe_id)
+    if recipe is not None or budget_mode() == REJECT:
+        return recipe
+
+    def fetch_from_api() -> dict | None:
+        response = get_recipe_information(recipe_id)
+        if response == 1:
+            return None
+        recipe_information = response.json()
+        ingest_recipes([recipe_information])
+        return recipe_information
+
+    # concurrent visitors of the same recipe share one API call
+    return single_flight(f'information:{recipe_id}', compute=fetch_from_api,
+                         lookup=lambda: get_complete_recipe(recipe_id))
+
+
+def complete_recipe(recipes: RecipeList, index: int) -> RecipeDetail:
+    """
+    :return: recipe of a stored response with its instructions and ingredients - lean search results
+        are completed with fetch_recipe_information and replaced in the list. When the API fails or the budget
+        is used up, the lean recipe is returned, like in REJECT mode (its complete flag stays False).
+    """
+    recipe = recipes[index]
+    if recipe.complete or recipe.id is None:
+        return recipe
+    try:
+        recipe_information = fetch_recipe_information(recipe.id)
+    except InternalServerError as e:  # includes BudgetExhausted
+        print(f"Recipe information unavailable: {e.description}")
+        return recipe
+    if recipe_information is None:
+        return recipe
+    recipe = RecipeDetail.from_payload(recipe_information)
+    recipes.replace(index, recipe)
+    return recipe
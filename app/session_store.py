@@ -0,0 +1,165 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+from typing import Optional
+from flask import Flask
+from flask_session import Session
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from .config import Config
+from .extensions import sqlalchemy_db
+
+
+class WriteOnModify:
+    """
+    Mixin for Flask-Session interfaces: stores a session only when it was modified,
+    or when less than half of its lifetime is left, instead of on every request.
+    Empty sessions, e.g. of anonymous visitors, are never stored by Flask-Session.
+    """
+
+    def init_expiry_tracking(self) -> None:
+        # expiry of the session loaded by the current thread, set by _retrieve_session_data
+        self.loaded = threading.local()
+
+    def open_session(self, app: Flask, request) -> ServerSideSession:
+        self.loaded.expires_at = None
+        session = super().open_session(app, request)
+        session.expires_at = self.loaded.expires_at
+        return session
+
+    def should_set_storage(self, app: Flask, session: ServerSideSession) -> bool:
+        if session.modified:
+            return True
+        expires_at = getattr(session, 'expires_at', None)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        return expires_at is None or expires_at - time.time() < lifetime / 2
+
+
+class SQLiteSessionInterface(WriteOnModify, ServerSideSessionInterface):
+    """
+    Stores sessions in a dedicated SQLite file in WAL mode, so session writes don't contend with writes
+    to users and recipes. Expired sessions are deleted in batches of SESSION_PURGE_BATCH.
+    """
+    ttl = False
+
+    def __init__(self, app: Flask, path: str, permanent: bool, cleanup_n_requests: Optional[int]):
+        self.path = path
+        self.thread_local = threading.local()
+        self.init_expiry_tracking()
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''
+                                   CREATE TABLE IF NOT EXISTS sessions (
+                                   id TEXT PRIMARY KEY,
+                                   data BLOB NOT NULL,
+                                   expires_at REAL NOT NULL
+                                   ) WITHOUT ROWID''')
+                connection.execute('''CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)''')
+        except sqlite3.Error as e:
+            print(f"Session table initialization error: {e}")
+        super().__init__(app, permanent=permanent, cleanup_n_requests=cleanup_n_requests)
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread to the sessions database, opening it on first use."""
+        connection = getattr(self.thread_local, 'connection', None)
+        if connection is None or self.thread_local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=Config.SQLITE_BUSY_TIMEOUT)
+            connection.execute('''PRAGMA journal_mode = WAL''')
+            connection.execute('''PRAGMA synchronous = NORMAL''')
+            self.thread_local.connection = connection
+            self.thread_local.pid = os.getpid()
+        return connection
+
+    def _retrieve_session_data(self, store_id: str) -> Optional[dict]:
+        try:
+            row = self.get_connection().execute('''SELECT data, expires_at FROM sessions
+                                                   WHERE id = ? AND expires_at > ?''',
+                                                (store_id, time.time())).fetchone()
+        except sqlite3.Error as e:
+            print(f"Database error while retrieving session: {e}")
+            return None
+        if row is None:
+            return None
+        self.loaded.expires_at = row[1]
+        return self.serializer.decode(row[0])
+
+    def _delete_session(self, store_id: str) -> None:
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''DELETE FROM sessions WHERE id = ?''', (store_id,))
+        except sqlite3.Error as e:
+            print(f"Database error while deleting session: {e}")
+
+    def _upsert_session(self, session_lifetime: timedelta, session: ServerSideSession, store_id: str) -> None:
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+                                      ON CONFLICT (id) DO UPDATE SET data = excluded.data,
+                                      expires_at = excluded.expires_at''',
+                                   (store_id, self.serializer.encode(session),
+                                    time.time() + session_lifetime.total_seconds()))
+        except sqlite3.Error as e:
+            print(f"Database error while saving session: {e}")
+
+    def _delete_expired_sessions(self) -> None:
+        """Deletes expired sessions, one batch per transaction, so that writers are never blocked for long."""
+        try:
+            connection = self.get_connection()
+            now = time.time()
+            while True:
+                with connection:
+                    cursor = connection.execute('''DELETE FROM sessions WHERE id IN
+                                                   (SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?)''',
+                                                (now, Config.SESSION_PURGE_BATCH))
+                if cursor.rowcount < Config.SESSION_PURGE_BATCH:
+                    break
+        except sqlite3.Error as e:
+            print(f"Database error while purging sessions: {e}")
+
+
+def create_redis_session_interface(app: Flask, permanent: bool) -> ServerSideSessionInterface:
+    """
+    Creates a Redis session interface shared by all workers, which writes sessions only when modified.
+    Redis expires sessions itself. Requires the redis package.
+    """
+    from redis import Redis
+    from flask_session.redis import RedisSessionInterface
+
+    class WriteOnModifyRedisSessionInterface(WriteOnModify, RedisSessionInterface):
+        def _retrieve_session_data(self, store_id: str) -> Optional[dict]:
+            data, ttl = self.client.pipeline().get(store_id).pttl(store_id).execute()
+            if data is None:
+                return None
+            self.loaded.expires_at = time.time() + ttl / 1000 if ttl > 0 else None
+            return self.serializer.decode(data)
+
+    interface = WriteOnModifyRedisSessionInterface(app, client=Redis.from_url(Config.SESSION_REDIS_URL),
+                                                   permanent=permanent)
+    interface.init_expiry_tracking()
+    return interface
+
+
+def init_sessions(app: Flask) -> None:
+    """
+    Sets up server-side sessions with the SESSION_BACKEND store:
+    sqlite - dedicated WAL database file in instance/, written only when sessions change,
+    redis - Redis shared by all workers, written only when sessions change,
+    sqlalchemy - Flask-Session's table in the main database, written on every request.
+    """
+    permanent = app.config.get('SESSION_PERMANENT', True)
+    backend = Config.SESSION_BACKEND
+    if backend == 'sqlite':
+        path = os.path.join('instance', Config.SESSION_DB_FILE)
+        app.session_interface = SQLiteSessionInterface(app, path, permanent, Config.SESSION_CLEANUP_N_REQUESTS)
+    elif backend == 'redis':
+        app.session_interface = create_redis_session_interface(app, permanent)
+    elif backend == 'sqlalchemy':
+        app.config['SESSION_TYPE'] = 'sqlalchemy'
+        app.config['SESSION_SQLALCHEMY'] = sqlalchemy_db
+        Session(app)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Any
+from .config import Config
+from .db_api_responses import get_connection
+from .cache_backend import get_remote_backend
+
+# seconds between checks whether another worker has finished the call
+POLL_INTERVAL = 0.05
+
+# identifies leases taken by this process
+owner_id = uuid.uuid4().hex
+
+
+class Call:
+    """An upstream call in progress within this process, awaited by all threads asking for the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+calls = {}
+calls_lock = threading.Lock()
+
+
+def init_leases() -> None:
+    """Creates the table of leases, which tell workers that an upstream call is already in progress elsewhere."""
+    try:
+        connection = get_connection()
+        with connection:
+            connection.execute('''
+                               CREATE TABLE IF NOT EXISTS upstream_leases (
+                               key TEXT PRIMARY KEY,
+                               owner TEXT NOT NULL,
+                               expires_at REAL NOT NULL
+                               )''')
+    except sqlite3.Error as e:
+        print(f"Lease table initialization error: {e}")
+
+
+def acquire_lease(key: str) -> bool:
+    """
+    Takes the lease on a key for UPSTREAM_LEASE_TTL seconds, unless another worker holds an unexpired one.
+    Leases are kept in the remote cache backend if there is one, so that they cover workers of all hosts.
+    :return: True if the lease was taken
+    """
+    backend = get_remote_backend()
+    if backend is not None:
+        return backend.add(f'lease:{key}', f'{owner_id}:{os.getpid()}', Config.UPSTREAM_LEASE_TTL)
+    try:
+        connection = get_connection()
+        now = time.time()
+        with connection:
+            connection.execute('''DELETE FROM upstream_leases WHERE key = ? AND expires_at < ?''', (key, now))
+            cursor = connection.execute('''INSERT OR IGNORE INTO upstream_leases (key, owner, expires_at)
+                                           VALUES (?, ?, ?)''',
+                                        (key, f'{owner_id}:{os.getpid()}', now + Config.UPSTREAM_LEASE_TTL))
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        # without the lease table, calls are only coalesced within the process
+        print(f"Database error while acquiring lease: {e}")
+        return True
+
+
+def release_lease(key: str) -> None:
+    """Releases a lease taken by this process."""
+    backend = get_remote_backend()
+    if backend is not None:
+        # a lease that expired meanwhile may have been taken by another worker - only delete our own
+        backend.delete_if_equal(f'lease:{key}', f'{owner_id}:{os.getpid()}')
+        return
+    try:
+        connection = get_connection()
+        with connection:
+            connection.execute('''DELETE FROM upstream_leases WHERE key = ? AND owner = ?''',
+                               (key, f'{owner_id}:{os.getpid()}'))
+    except sqlite3.Error as e:
+        print(f"Database error while releasing lease: {e}")
+
+
+def call_with_lease(key: str, compute: Callable[[], Any], lookup: Callable[[], Any]) -> Any:
+    """
+    Runs compute() once the lease on the key is taken. While another worker holds the lease,
+    waits for its result to appear through lookup() instead.
+    If it doesn't appear within UPSTREAM_LEASE_TTL, computes anyway.
+    """
+    deadline = time.time() + Config.UPSTREAM_LEASE_TTL
+    while not acquire_lease(key):
+        result = lookup()
+        if result is not None:
+            return result
+        if time.time() > deadline:
+            return compute()
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        # the previous holder may have finished between our lookup and taking the lease
+        result = lookup()
+        if result is not None:
+            return result
+        return compute()
+    finally:
+        release_lease(key)
+
+
+def single_flight(key: str, compute: Callable[[], Any], lookup: Callable[[], Any]) -> Any:
+    """
+    Coalesces identical upstream calls: while a call for the key is in flight, in this process or in another worker,
+    other callers wait for its result instead of repeating it.
+    :param key: canonical key of the call, e.g. the cache key of a query
+    :param compute: performs the upstream call and stores its result where lookup() finds it
+    :param lookup: returns the stored result or None
+    :return: result of compute(), or of lookup() when another worker made the call
+    """
+    with calls_lock:
+        call = calls.get(key)
+        leader = call is None
+        if leader:
+            call = calls[key] = Call()
+
+    if not leader:
+        if not call.done.wait(Config.UPSTREAM_LEASE_TTL):
+            return call_with_lease(key, compute, lookup)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = call_with_lease(key, compute, lookup)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with calls_lock:
+            del calls[key]
+        call.done.set()
@@ -0,0 +1,76 @@
+"""
+Helpers shared by the benchmarks: a throwaway working directory for the app and saved baselines.
+"""
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# directory the benchmark was started from - prepare_environment() leaves it, baseline paths are relative to it
+START_DIR = os.getcwd()
+
+
+def prepare_environment(spoonacular_url: str = 'http://127.0.0.1:9') -> str:
+    """
+    Points the app at a fresh working directory with its own databases and at a fake spoonacular server,
+    so benchmarks never touch real data or API quota. Must run before the app is imported.
+    :return: path of the working directory
+    """
+    workdir = tempfile.mkdtemp(prefix='recipe-finder-bench-')
+    shutil.copy(os.path.join(REPO_ROOT, 'data.json'), workdir)
+    os.makedirs(os.path.join(workdir, 'instance'), exist_ok=True)
+    os.chdir(workdir)
+    os.environ.update({
+        'SPOONACULAR_BASE_URL': spoonacular_url,
+        'response_db_file': 'responses.db',
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'instance', 'app.db')}",
+        'RANDOM_POOL_PREWARM': '0',
+    })
+    for name, value in [('API_KEY', 'benchmark'), ('SECRET_KEY', 'benchmark'), ('WTF_CSRF_SECRET_KEY', 'benchmark')]:
+        os.environ.setdefault(name, value)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return workdir
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """:return: nearest-rank percentile of already sorted values, 0 for no values"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def save_baseline(path: str, results: dict) -> None:
+    """Writes benchmark results as a baseline for later runs."""
+    path = os.path.join(START_DIR, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print(f"Baseline saved to {path}")
+
+
+def compare_to_baseline(path: str, results: dict, metric: str, tolerance: float,
+                        higher_is_better: bool = False) -> bool:
+    """
+    Compares one metric of every benchmark with a saved baseline and prints the changes.
+    :param metric: key of the metric in every result, e.g. 'p95_ms'
+    :param tolerance: allowed relative change for the worse, e.g. 0.2 for 20%
+    :return: True if no benchmark got worse by more than the tolerance
+    """
+    with open(os.path.join(START_DIR, path)) as file:
+        baseline = json.load(file)
+    passed = True
+    for name, result in sorted(results.items()):
+        if name not in baseline or not baseline[name].get(metric):
+            continue
+        before, after = baseline[name][metric], result[metric]
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        status = 'REGRESSION' if worse > tolerance else 'ok'
+        passed = passed and worse <= tolerance
+        print(f"{name:<28} {metric} {before:>10.3f} -> {after:>10.3f} ({change:+.1%}) {status}")
+    return passed
@@ -0,0 +1,169 @@
+"""
+Local stand-in for Redis, so the shared cache backend (CACHE_BACKEND=redis) can be tried and benchmarked
+without a Redis server.
+
+Speaks the Redis protocol (RESP2) with the commands the app's cache and session store use:
+PING, GET, SET (EX, PX, NX, XX), DEL, EXISTS, MGET, PTTL, FLUSHDB, FLUSHALL, SELECT and CLIENT.
+EVAL runs the app's Lua scripts only - they are recognized by their source, not interpreted.
+Values live in memory and expire lazily. Several app instances pointed at it share their caches like
+app servers sharing one Redis.
+
+Usage:
+    python benchmarks/fake_redis.py --port 6390
+    CACHE_BACKEND=redis CACHE_REDIS_URL=redis://127.0.0.1:6390/0 gunicorn wsgi:app
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+# app.cache_backend.DELETE_IF_EQUAL_SCRIPT - importing the app here would read its config too early
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class FakeRedis:
+    """Fake Redis server running in a background thread."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        # key -> (value, expiry time or None)
+        self.data = {}
+        self.commands = {}
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'redis://{host}:{port}/0'
+
+    def start(self) -> 'FakeRedis':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def lookup(self, key: bytes) -> bytes | None:
+        """:return: unexpired value of a key, dropping an expired one (called with the lock held)"""
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0]
+
+    def set(self, arguments: list[bytes]):
+        key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+        expires_at = None
+        for name, unit in ((b'EX', 1), (b'PX', 0.001)):
+            if name in options:
+                expires_at = time.monotonic() + int(arguments[2 + options.index(name) + 1]) * unit
+        exists = self.lookup(key) is not None
+        if (b'NX' in options and exists) or (b'XX' in options and not exists):
+            return None
+        self.data[key] = (value, expires_at)
+        return 'OK'
+
+    def eval(self, arguments: list[bytes]):
+        script, num_keys = arguments[0].decode(), int(arguments[1])
+        keys, args = arguments[2:2 + num_keys], arguments[2 + num_keys:]
+        if script.split() == DELETE_IF_EQUAL_SCRIPT.split():
+            if self.lookup(keys[0]) != args[0]:
+                return 0
+            del self.data[keys[0]]
+            return 1
+        return ValueError("ERR unknown script")
+
+    def execute(self, command: list[bytes]):
+        """:return: reply to a command: str (status), int, bytes, None, list or Exception"""
+        name, arguments = command[0].upper().decode(), command[1:]
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+            if name == 'PING':
+                return 'PONG'
+            if name in ('SELECT', 'CLIENT'):
+                return 'OK'
+            if name == 'GET':
+                return self.lookup(arguments[0])
+            if name == 'MGET':
+                return [self.lookup(key) for key in arguments]
+            if name == 'SET':
+                return self.set(arguments)
+            if name == 'DEL':
+                return sum(self.data.pop(key, None) is not None for key in arguments)
+            if name == 'EXISTS':
+                return sum(self.lookup(key) is not None for key in arguments)
+            if name == 'EVAL':
+                return self.eval(arguments)
+            if name == 'PTTL':
+                if self.lookup(arguments[0]) is None:
+                    return -2
+                expires_at = self.data[arguments[0]][1]
+                return -1 if expires_at is None else int((expires_at - time.monotonic()) * 1000)
+            if name in ('FLUSHDB', 'FLUSHALL'):
+                self.data.clear()
+                return 'OK'
+        return ValueError(f"ERR unknown command '{name}'")
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def read_command(self) -> list[bytes] | None:
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                if not line.startswith(b'*'):
+                    return line.split()
+                command = []
+                for _ in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    command.append(self.rfile.read(length + 2)[:-2])
+                return command
+
+            def encode(self, reply) -> bytes:
+                if reply is None:
+                    return b'$-1\r\n'
+                if isinstance(reply, Exception):
+                    return f'-{reply}\r\n'.encode()
+                if isinstance(reply, str):
+                    return f'+{reply}\r\n'.encode()
+                if isinstance(reply, int):
+                    return f':{reply}\r\n'.encode()
+                if isinstance(reply, list):
+                    return f'*{len(reply)}\r\n'.encode() + b''.join(self.encode(item) for item in reply)
+                return f'${len(reply)}\r\n'.encode() + reply + b'\r\n'
+
+            def handle(self):
+                while True:
+                    command = self.read_command()
+                    if command is None:
+                        return
+                    if command:
+                        self.wfile.write(self.encode(fake.execute(command)))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    fake = FakeRedis(args.host, args.port)
+    print(f"Fake Redis listening on {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+Local stand-in for the spoonacular API, so the app can be benchmarked without spending quota.
+
+Serves /recipes/complexSearch, /recipes/random and /recipes/<id>/information from a pool of recipes:
+recorded responses (--payloads, a directory of JSON files saved from the real API) or generated ones.
+Latency and error rate are configurable, responses carry X-API-Quota-* headers like the real API.
+
+Usage:
+    python benchmarks/fake_spoonacular.py --port 8089 --latency 150 --jitter 50 --error-rate 0.02
+    SPOONACULAR_BASE_URL=http://127.0.0.1:8089 gunicorn wsgi:app
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ADJECTIVES = ['Creamy', 'Spicy', 'Roasted', 'Grilled', 'Easy', 'Quick', 'Healthy', 'Crispy', 'Smoky', 'Lemon',
+              'Garlic', 'Honey', 'Herbed', 'Rustic', 'Classic', 'Sweet']
+MAINS = ['Chicken', 'Salmon', 'Tofu', 'Beef', 'Shrimp', 'Mushroom', 'Chickpea', 'Pork', 'Lentil', 'Cauliflower',
+         'Turkey', 'Eggplant', 'Spinach', 'Potato', 'Tomato', 'Pumpkin']
+DISHES = ['Pasta', 'Curry', 'Salad', 'Soup', 'Tacos', 'Stew', 'Risotto', 'Burger', 'Pizza', 'Stir Fry', 'Casserole',
+          'Bowl', 'Sandwich', 'Pie', 'Skewers', 'Noodles']
+INGREDIENTS = ['salt', 'pepper', 'olive oil', 'garlic', 'onion', 'butter', 'flour', 'egg', 'milk', 'lemon juice',
+               'parsley', 'basil', 'tomato paste', 'chicken broth', 'rice', 'cheese', 'sugar', 'cumin', 'paprika',
+               'cream', 'carrot', 'celery', 'soy sauce', 'ginger']
+CUISINES = ['Italian', 'Mexican', 'Indian', 'Chinese', 'French', 'American', 'Thai', 'Greek', 'Japanese',
+            'Mediterranean', 'Spanish', 'Korean']
+DIETS = ['gluten free', 'dairy free', 'lacto ovo vegetarian', 'vegan', 'ketogenic', 'paleolithic', 'pescatarian']
+
+
+def generate_recipe(recipe_id: int) -> dict:
+    """:return: recipe with the fields and roughly the size of a full spoonacular recipe"""
+    rng = random.Random(recipe_id)
+    ingredients = rng.sample(INGREDIENTS, rng.randint(6, 14))
+    steps = [{'number': number, 'step': f"{rng.choice(['Mix', 'Chop', 'Simmer', 'Bake', 'Stir', 'Season'])} "
+                                        f"the {' and '.join(rng.sample(ingredients, 2))} for {rng.randint(2, 40)} "
+                                        f"minutes, until it is ready for the next step.",
+              'ingredients': [{'id': rng.randint(1000, 20000), 'name': name, 'image': f'{name}.png'}
+                              for name in rng.sample(ingredients, rng.randint(1, 3))],
+              'equipment': [{'id': 404784, 'name': 'oven', 'image': 'oven.jpg'}]}
+             for number in range(1, rng.randint(4, 10))]
+    diets = sorted(rng.sample(DIETS, rng.randint(0, 3)))
+    return {
+        'id': recipe_id,
+        'title': f'{rng.choice(ADJECTIVES)} {rng.choice(MAINS)} {rng.choice(DISHES)}',
+        'image': f'https://img.spoonacular.com/recipes/{recipe_id}-312x231.jpg',
+        'imageType': 'jpg',
+        'readyInMinutes': rng.randint(10, 120),
+        'servings': rng.randint(1, 8),
+        'cuisines': rng.sample(CUISINES, rng.randint(0, 2)),
+        'diets': diets,
+        'vegan': 'vegan' in diets,
+        'vegetarian': 'vegan' in diets or 'lacto ovo vegetarian' in diets,
+        'glutenFree': 'gluten free' in diets,
+        'dairyFree': 'dairy free' in diets or 'vegan' in diets,
+        'aggregateLikes': rng.randint(0, 5000),
+        'healthScore': rng.randint(0, 100),
+        'summary': ' '.join(rng.choice(INGREDIENTS) for _ in range(120)),
+        'analyzedInstructions': [{'name': '', 'steps': steps}],
+        'extendedIngredients': [{'id': rng.randint(1000, 20000), 'name': name, 'amount': rng.randint(1, 4),
+                                 'unit': 'cup', 'original': f'{rng.randint(1, 4)} cups {name}'}
+                                for name in ingredients],
+        'nutrition': {'nutrients': [{'name': f'Nutrient {number}', 'amount': rng.random() * 100, 'unit': 'g',
+                                     'percentOfDailyNeeds': rng.random() * 50} for number in range(30)]},
+    }
+
+
+def load_recorded_recipes(directory: str) -> list[dict]:
+    """:return: recipes of all JSON files in the directory - search or random responses, or single recipes"""
+    recipes = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(path) as file:
+            payload = json.load(file)
+        for recipe in payload.get('results', payload.get('recipes', [payload])):
+            if 'id' in recipe and 'title' in recipe:
+                recipes[recipe['id']] = recipe
+    return list(recipes.values())
+
+
+class FakeSpoonacular:
+    """Fake spoonacular server running in a background thread."""
+
+    def __init__(self, recipes: list[dict], host: str = '127.0.0.1', port: int = 0, latency_ms: float = 0,
+                 jitter_ms: float = 0, error_rate: float = 0, quota: float = 1_000_000):
+        self.recipes = sorted(recipes, key=lambda recipe: -recipe.get('aggregateLikes', 0))
+        self.recipes_by_id = {recipe['id']: recipe for recipe in recipes}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.quota = quota
+        self.used = 0.0
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeSpoonacular':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def search(self, params: dict) -> dict:
+        """Answers complexSearch: all query words in the title, any of the cuisines, all of the diets."""
+        words = params.get('query', '').lower().split()
+        cuisines = {cuisine.strip().lower() for cuisine in params.get('cuisine', '').split(',') if cuisine.strip()}
+        diets = {diet.strip().lower() for diet in params.get('diet', '').split(',') if diet.strip()}
+        matches = [recipe for recipe in self.recipes
+                   if all(word in recipe['title'].lower() for word in words)
+                   and (not cuisines or cuisines & {cuisine.lower() for cuisine in recipe.get('cuisines', [])})
+                   and diets <= {diet.lower() for diet in recipe.get('diets', [])}]
+        offset, number = int(params.get('offset', 0)), int(params.get('number', 10))
+        full = any(params.get(section) == 'true'
+                   for section in ['addRecipeInformation', 'addRecipeInstructions', 'addRecipeNutrition'])
+        results = [recipe if full else {key: recipe.get(key) for key in ['id', 'title', 'image', 'imageType']}
+                   for recipe in matches[offset:offset + number]]
+        return {'results': results, 'offset': offset, 'number': number, 'totalResults': len(matches)}
+
+    def respond(self, path: str, params: dict) -> tuple[int, dict, float]:
+        """:return: status, body and quota points of a request"""
+        if random.random() < self.error_rate:
+            return 500, {'status': 'failure', 'message': 'Injected error'}, 0
+        number = int(params.get('number', 1))
+        if path == '/recipes/complexSearch':
+            return 200, self.search(params), 1 + 0.01 * number
+        if path == '/recipes/random':
+            sample = random.sample(self.recipes, min(number, len(self.recipes)))
+            return 200, {'recipes': sample}, 1 + 0.01 * number
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'recipes' and parts[2] == 'information' and parts[1].isdigit():
+            recipe = self.recipes_by_id.get(int(parts[1]))
+            if recipe is None:
+                return 404, {'status': 'failure', 'message': 'A recipe with this id does not exist.'}, 1
+            return 200, recipe, 1
+        return 404, {'status': 'failure', 'message': 'Unknown endpoint.'}, 0
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                if fake.latency_ms or fake.jitter_ms:
+                    time.sleep(max(random.gauss(fake.latency_ms, fake.jitter_ms), 0) / 1000)
+                status, body, points = fake.respond(url.path, params)
+                with fake.lock:
+                    fake.used += points
+                    fake.requests[url.path] = fake.requests.get(url.path, 0) + 1
+                    used = fake.used
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('X-API-Quota-Request', f'{points:.2f}')
+                self.send_header('X-API-Quota-Used', f'{used:.2f}')
+                self.send_header('X-API-Quota-Left', f'{max(fake.quota - used, 0):.2f}')
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def create_fake_server(payloads: str | None = None, recipes: int = 2000, **options) -> FakeSpoonacular:
+    """Creates a fake server with recorded recipes from the payloads directory, or generated ones."""
+    pool = load_recorded_recipes(payloads) if payloads else [generate_recipe(i) for i in range(1, recipes + 1)]
+    return FakeSpoonacular(pool, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--payloads', help='directory of recorded spoonacular responses (JSON files)')
+    parser.add_argument('--recipes', type=int, default=2000, help='number of generated recipes without --payloads')
+    parser.add_argument('--latency', type=float, default=0, help='mean response latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='standard deviation of the latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with 500')
+    parser.add_argument('--quota', type=float, default=1_000_000, help='daily quota reported in the headers')
+    args = parser.parse_args()
+
+    server = create_fake_server(args.payloads, args.recipes, host=args.host, port=args.port,
+                                latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate,
+                                quota=args.quota)
+    print(f"Fake spoonacular with {len(server.recipes)} recipes at {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""
+Concurrent load driver: virtual users browse the app (home page, search, results, details, preferences,
+saving recipes) and every route's throughput and p50/p95/p99 latency is reported.
+
+By default the app runs in this process on a threaded werkzeug server, against the fake spoonacular server
+(see fake_spoonacular.py) and throwaway databases. --target drives an app started elsewhere instead,
+e.g. gunicorn configured with SPOONACULAR_BASE_URL pointing to a fake server.
+
+--sweep measures how many concurrent searches one worker sustains: for every concurrency level, users only
+search for queries the app must send to spoonacular. --mode sync serves one request at a time, like a sync
+gunicorn worker (GUNICORN_THREADS=1); --mode threaded serves requests on threads calling spoonacular through
+the requests session, like a gthread worker with UPSTREAM_MODE=sync (the default); --mode async serves requests
+on threads, which wait for spoonacular on the shared async client, like a gthread worker with UPSTREAM_MODE=async.
+Comparing threaded with async shows what the async client adds on top of threads.
+
+--cache selects the shared cache backend of the app started in this process; 'redis' starts the Redis stand-in
+(see fake_redis.py). To see hosts share results, start several app servers with CACHE_BACKEND=redis against one
+fake_redis.py and drive each of them with --target: repeated searches reach spoonacular once, not once per host.
+
+Usage:
+    python benchmarks/loadtest.py --users 16 --duration 30
+    python benchmarks/loadtest.py --users 16 --duration 30 --save-baseline benchmarks/baselines/loadtest.json
+    python benchmarks/loadtest.py --users 16 --duration 30 --baseline benchmarks/baselines/loadtest.json
+    python benchmarks/loadtest.py --sweep 1,4,16,64 --duration 10 --mode sync
+    python benchmarks/loadtest.py --sweep 1,4,16,64 --duration 10 --mode threaded
+    python benchmarks/loadtest.py --sweep 1,4,16,64 --duration 10 --mode async
+    python benchmarks/loadtest.py --users 16 --duration 30 --cache redis
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import requests
+from common import prepare_environment, percentile, save_baseline, compare_to_baseline
+from fake_spoonacular import create_fake_server, ADJECTIVES, MAINS, DISHES, CUISINES
+from fake_redis import FakeRedis
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" value="([^"]+)"')
+DETAILS_LINK = re.compile(r'/dishDetails/(\d+)/([^"]+)"')
+
+
+def start_app(threaded: bool = True) -> str:
+    """
+    Starts the app on a werkzeug server in this process.
+    :param threaded: serve requests on threads, otherwise one at a time
+    :return: its base URL
+    """
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # the load driver talks plain HTTP
+    app.config.update(SESSION_COOKIE_SECURE=False, REMEMBER_COOKIE_SECURE=False)
+    server = make_server('127.0.0.1', 0, app, threaded=threaded)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+class Recorder:
+    """Collects the latency and outcome of every request."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, route: str, seconds: float, ok: bool) -> None:
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        """:return: per route (and 'all'): requests, errors, requests per second and latency percentiles in ms"""
+        with self.lock:
+            samples = {route: sorted(values) for route, values in self.samples.items()}
+            errors = dict(self.errors)
+        samples['all'] = sorted(value for values in samples.values() for value in values)
+        errors['all'] = sum(errors.values())
+        return {route: {'requests': len(values), 'errors': errors.get(route, 0), 'rps': len(values) / duration,
+                        'p50_ms': percentile(values, 0.50) * 1000, 'p95_ms': percentile(values, 0.95) * 1000,
+                        'p99_ms': percentile(values, 0.99) * 1000}
+                for route, values in samples.items()}
+
+
+class VirtualUser:
+    """A visitor with its own cookies, who registers once and then browses in a loop."""
+
+    def __init__(self, base_url: str, number: int, recorder: Recorder):
+        self.base_url = base_url
+        self.number = number
+        self.recorder = recorder
+        self.session = requests.Session()
+        self.csrf_token = None
+
+    def request(self, route: str, method: str, path: str, **kwargs) -> requests.Response | None:
+        """Sends a request without following redirects and records it under the route's name."""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, allow_redirects=False, timeout=60,
+                                            **kwargs)
+        except requests.RequestException:
+            self.recorder.record(route, time.perf_counter() - start, False)
+            return None
+        self.recorder.record(route, time.perf_counter() - start, response.status_code < 400)
+        token = CSRF_TOKEN.search(response.text) if 'text/html' in response.headers.get('Content-Type', '') else None
+        if token:
+            self.csrf_token = token.group(1)
+        return response
+
+    def register(self) -> None:
+        self.request('register_page', 'GET', '/register')
+        password = 'Bench1!pass'
+        self.request('register', 'POST', '/register',
+                     data={'email': f'user{self.number}-{random.randrange(10 ** 9)}@example.com',
+                           'password': password, 'confirm_password': password, 'name': f'User {self.number}',
+                           'csrf_token': self.csrf_token})
+
+    def browse(self) -> None:
+        """One visit: home page, a search with its results, a recipe's details, saving it, a filtered search."""
+        self.request('start', 'GET', '/')
+        query = random.choice([random.choice(MAINS), random.choice(DISHES),
+                               f'{random.choice(ADJECTIVES)} {random.choice(MAINS)}'])
+        response = self.request('search', 'POST', '/', data={'search': query, 'csrf_token': self.csrf_token})
+        if response is not None and 'searchingResults' in response.headers.get('Location', ''):
+            response = self.request('searching_results', 'GET', response.headers['Location'])
+            links = DETAILS_LINK.findall(response.text) if response is not None else []
+            if links:
+                recipe_number, unique_name = random.choice(links)
+                self.request('details', 'GET', f'/dishDetails/{recipe_number}/{unique_name}')
+                self.request('save_recipe', 'POST', f'/saveRecipe/{unique_name}/{recipe_number}',
+                             data={'csrf_token': self.csrf_token}, headers={'Referer': self.base_url + '/'})
+
+        self.request('preferences', 'GET', '/preferences?filter_type=2')
+        response = self.request('preferences_search', 'POST', '/preferences',
+                                data={'checkBox': random.sample(CUISINES, 2), 'type': '2',
+                                      'csrf_token': self.csrf_token})
+        if response is not None and 'searchingResults' in response.headers.get('Location', ''):
+            self.request('searching_results', 'GET', response.headers['Location'])
+
+    def run(self, deadline: float) -> None:
+        while time.time() < deadline:
+            self.browse()
+
+    def search_until(self, deadline: float) -> None:
+        """Searches for random dish names until the deadline - without logging in, the home page, or results."""
+        self.request('error_page', 'GET', '/error')
+        while time.time() < deadline:
+            query = f'{random.choice(ADJECTIVES)} {random.choice(MAINS)} {random.choice(DISHES)}'
+            self.request('search', 'POST', '/', data={'search': query, 'csrf_token': self.csrf_token})
+
+
+def run_threads(functions: list) -> None:
+    """Runs every function in its own thread and waits for all of them."""
+    threads = [threading.Thread(target=function) for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{'route':<20} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, result in sorted(summary.items(), key=lambda item: (item[0] == 'all', item[0])):
+        print(f"{route:<20} {result['requests']:>9} {result['errors']:>7} {result['rps']:>9.1f} "
+              f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f}")
+
+
+def run_sweep(base_url: str, levels: list[int], duration: float) -> dict:
+    """
+    Runs searches at every concurrency level for the given duration.
+    :return: summary of the searches per level, keyed 'search_x<level>'
+    """
+    results = {}
+    print(f"{'concurrency':>11} {'searches':>9} {'errors':>7} {'search/s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for level in levels:
+        recorder = Recorder()
+        deadline = time.time() + duration
+        start = time.time()
+        run_threads([lambda number=number: VirtualUser(base_url, number, recorder).search_until(deadline)
+                     for number in range(level)])
+        result = recorder.summary(time.time() - start).get('search', {'requests': 0, 'errors': 0, 'rps': 0,
+                                                                      'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0})
+        results[f'search_x{level}'] = result
+        print(f"{level:>11} {result['requests']:>9} {result['errors']:>7} {result['rps']:>9.1f} "
+              f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f}")
+    return results
+
+
+def report(args: argparse.Namespace, summary: dict) -> None:
+    """Saves the results as a baseline or compares them with one, as requested on the command line."""
+    if args.save_baseline:
+        save_baseline(args.save_baseline, summary)
+    if args.baseline:
+        latency_ok = compare_to_baseline(args.baseline, summary, 'p95_ms', args.tolerance)
+        throughput_ok = compare_to_baseline(args.baseline, summary, 'rps', args.tolerance, higher_is_better=True)
+        if not (latency_ok and throughput_ok):
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=8, help='number of concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of browsing')
+    parser.add_argument('--target', help='base URL of an app started elsewhere')
+    parser.add_argument('--payloads', help='directory of recorded spoonacular responses for the fake server')
+    parser.add_argument('--latency', type=float, default=100, help='mean latency of the fake server in ms')
+    parser.add_argument('--jitter', type=float, default=30, help='latency deviation of the fake server in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of fake server errors')
+    parser.add_argument('--sweep', help='comma separated concurrency levels of a search-only sweep, e.g. 1,4,16')
+    parser.add_argument('--mode', choices=['sync', 'threaded', 'async'],
+                        help='serving mode of the app started in this process (default: threaded, UPSTREAM_MODE '
+                             'from the environment)')
+    parser.add_argument('--cache', choices=['memory', 'sqlite', 'redis'],
+                        help='shared cache backend of the app started in this process (default: CACHE_BACKEND '
+                             'from the environment)')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 and throughput regression')
+    args = parser.parse_args()
+
+    base_url = args.target
+    if base_url is None:
+        fake = create_fake_server(args.payloads, latency_ms=args.latency, jitter_ms=args.jitter,
+                                  error_rate=args.error_rate).start()
+        prepare_environment(fake.url)
+        if args.mode:
+            os.environ['UPSTREAM_MODE'] = 'async' if args.mode == 'async' else 'sync'
+        if args.cache:
+            os.environ['CACHE_BACKEND'] = args.cache
+        if args.cache == 'redis':
+            os.environ['CACHE_REDIS_URL'] = FakeRedis().start().url
+        if args.sweep:
+            # every search goes to spoonacular: no local answers, stored responses expire at once
+            os.environ.update({'LOCAL_SEARCH_MIN_HITS': '1000000', 'RESPONSE_CACHE_TTL': '0'})
+        base_url = start_app(threaded=args.mode != 'sync')
+
+    if args.sweep:
+        summary = run_sweep(base_url, [int(level) for level in args.sweep.split(',')], args.duration)
+        if args.target is None:
+            print(f"Fake spoonacular requests: {fake.requests}")
+        report(args, summary)
+        return
+
+    # users sign up before the measurement starts
+    setup_recorder, recorder = Recorder(), Recorder()
+    virtual_users = [VirtualUser(base_url, number, setup_recorder) for number in range(args.users)]
+    run_threads([user.register for user in virtual_users])
+    for user in virtual_users:
+        user.recorder = recorder
+
+    start = time.time()
+    deadline = start + args.duration
+    run_threads([lambda user=user: user.run(deadline) for user in virtual_users])
+    summary = recorder.summary(time.time() - start)
+    print_summary(summary)
+    if args.target is None:
+        print(f"Fake spoonacular requests: {fake.requests}")
+
+    report(args, summary)
+
+
+if __name__ == '__main__':
+    main()
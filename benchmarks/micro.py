@@ -0,0 +1,112 @@
+"""
+Micro-benchmarks of hot functions: parsing recipes for templates, the stored-response cache,
+the local recipe store and the filter index. Runs against throwaway databases.
+
+Usage:
+    python benchmarks/micro.py
+    python benchmarks/micro.py --save-baseline benchmarks/baselines/micro.json
+    python benchmarks/micro.py --baseline benchmarks/baselines/micro.json --tolerance 0.25
+"""
+import argparse
+import sys
+import time
+from common import prepare_environment, save_baseline, compare_to_baseline
+from fake_spoonacular import generate_recipe
+
+
+def measure(function, repeat: int = 5, min_seconds: float = 0.2) -> float:
+    """:return: best time of one call in microseconds, over repeat rounds of at least min_seconds each"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds / 10:
+            break
+        number *= 10
+    number = max(int(number * min_seconds / max(elapsed, 1e-9)), 1)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best * 1e6
+
+
+def run_benchmarks(selected: list[str] | None) -> dict:
+    prepare_environment()
+    from app.db_api_responses import (init_db, make_cache_key, pass_response_to_database,
+                                      obtain_response_from_database)
+    from app.payload_format import encode_recipes, decode_recipes, slim_recipe
+    from app.recipe_model import RecipeDetail, load_recipes
+    from app.recipe_store import init_recipe_store, ingest_recipes, search_local_recipes
+    from app.filter_index import filter_index
+
+    init_db()
+    init_recipe_store()
+    recipes = [generate_recipe(recipe_id) for recipe_id in range(1, 2001)]
+    page = recipes[:12]
+    stored_recipe = slim_recipe(page[0])
+    encoded_page = encode_recipes(page)
+    pass_response_to_database('benchmark', page)
+    for start in range(0, len(recipes), 500):
+        ingest_recipes(recipes[start:start + 500])
+    load_recipes('benchmark')
+
+    def decode_page():
+        for recipe in decode_recipes(encoded_page):
+            pass
+
+    def obtain_page():
+        for recipe in obtain_response_from_database('benchmark'):
+            pass
+
+    def load_page():
+        recipe_list = load_recipes('benchmark')
+        for i in range(len(recipe_list)):
+            recipe_list[i]
+
+    benchmarks = {
+        'recipe_detail_from_payload': lambda: RecipeDetail.from_payload(stored_recipe),
+        'make_cache_key': lambda: make_cache_key(query='pasta', intolerances=['Dairy', 'Egg'], cuisine=None,
+                                                 diet=['vegan']),
+        'encode_recipes_12': lambda: encode_recipes(page),
+        'decode_recipes_12': decode_page,
+        'pass_response_to_database_12': lambda: pass_response_to_database('benchmark-write', page),
+        'pass_response_to_database_12_no_wait': lambda: pass_response_to_database('benchmark-slot', page,
+                                                                                  wait=False),
+        'obtain_response_from_database_12': obtain_page,
+        'load_recipes_12_memoized': load_page,
+        'search_local_recipes': lambda: search_local_recipes('creamy chicken'),
+        'filter_recipes': lambda: filter_index.filter_recipes(cuisine_type=['Italian', 'Mexican'],
+                                                              diet_type=['Vegetarian']),
+    }
+    results = {}
+    for name, function in benchmarks.items():
+        if selected and name not in selected:
+            continue
+        microseconds = measure(function)
+        results[name] = {'us_per_call': microseconds}
+        print(f"{name:<36} {microseconds:>12.2f} us")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='benchmarks to run (all by default)')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+    if args.baseline and not compare_to_baseline(args.baseline, results, 'us_per_call', args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
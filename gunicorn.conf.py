@@ -0,0 +1,19 @@
+"""
+Gunicorn settings, read automatically by `gunicorn wsgi:app` (see Procfile).
+
+Workers are threaded (gthread): one worker serves GUNICORN_THREADS requests at once, so requests waiting
+for spoonacular don't hold a whole worker. This holds for both upstream modes - with UPSTREAM_MODE=sync
+the threads share the worker's requests session, with UPSTREAM_MODE=async its async client
+(see app/async_api.py). GUNICORN_THREADS=1 runs sync workers, which serve one request at a time.
+"""
+import os
+
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+
+def worker_exit(server, worker):
+    """Writes the responses still queued by the worker's write-behind thread."""
+    from app.db_api_responses import drain_pending_writes
+    drain_pending_writes()